@@ -0,0 +1,101 @@
+"""Measure how much memory package records take up.
+
+Run this with "poetry run python benchmarks/bench_memory.py".
+"""
+
+import argparse
+import gc
+import json
+import tracemalloc
+from datetime import datetime
+from typing import Any, Callable, NamedTuple, Optional
+
+import packaging.version
+
+from ghpypi import ghpypi
+
+
+class TuplePackage(NamedTuple):
+    # this is what packages looked like before they were made smaller
+    filename: str
+    url: str
+    sha256: str
+    uploaded_at: datetime
+    uploaded_by: str
+    name: str
+    version: packaging.version.Version
+    metadata_sha256: Optional[str] = None
+
+
+def get_assets(count: int) -> list[dict[str, Any]]:
+    # a thousand packages across fifty repositories where every release has
+    # a couple of wheels and a source distribution
+    kinds = ["py3-none-any.whl", "cp312-cp312-manylinux_2_17_x86_64.whl", "tar.gz"]
+    assets = []
+    for i in range(count):
+        release, kind = divmod(i, len(kinds))
+        package = f"package{release % 1000}"
+        version = f"{release // 1000 // 100}.{release // 1000 % 100}.0"
+        filename = f"{package}-{version}.{kinds[kind]}" if kind == 2 else f"{package}-{version}-{kinds[kind]}"
+        assets.append(
+            {
+                "filename": filename,
+                "url": f"https://github.com/paullockaby/repo{release % 50}/releases/download/v{version}/{filename}",
+                "sha256": f"{i:064x}",
+                "uploaded_at": f"2021-12-25T06:{i // 60 % 60:02d}:{i % 60:02d}",
+                "uploaded_by": "github-actions[bot]",
+                "name": package,
+                "version": version,
+            },
+        )
+    return assets
+
+
+def measure(label: str, factory: Callable[..., object], assets: list[dict[str, Any]]) -> int:
+    # versions are the same objects either way so they are made ahead of time
+    versions = {x["version"]: packaging.version.Version(x["version"]) for x in assets}
+    data = json.dumps(assets)
+
+    # everything that comes from the api is counted because whatever the
+    # records hold on to stays around for as long as they do
+    gc.collect()
+    tracemalloc.start()
+    assets = json.loads(data)
+    records = [
+        factory(
+            filename=x["filename"],
+            url=x["url"],
+            sha256=x["sha256"],
+            uploaded_at=datetime.fromisoformat(x["uploaded_at"]),
+            uploaded_by=x["uploaded_by"],
+            name=x["name"],
+            version=versions[x["version"]],
+        )
+        for x in assets
+    ]
+
+    # the strings from the api that nobody kept go away once the records are made
+    del assets
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{label:<20} {size / 1024 / 1024:8.1f} MiB {size / len(records):8.0f} bytes per record")
+    return size
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=200_000)
+    args = parser.parse_args()
+
+    assets = get_assets(args.count)
+    print(f"making {len(assets):,} records")
+
+    before = measure("named tuples", TuplePackage, assets)
+    after = measure("compact records", ghpypi.Package, assets)
+    print(f"compact records use {100 - 100 * after / before:.0f}% less memory")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Measure how long it takes to sort packages with lots of files.
+
+Run this with "poetry run python benchmarks/bench_sorting.py".
+"""
+
+import argparse
+import random
+import time
+from datetime import datetime
+from typing import Callable
+
+from ghpypi import ghpypi
+
+
+def get_packages(count: int, seed: int = 0) -> list[ghpypi.Package]:
+    # one package with lots of versions and a few files for every version,
+    # like a project that publishes nightly builds
+    rng = random.Random(seed)  # noqa: S311
+    packages = []
+    for i in range(count):
+        version = f"{i // 300}.{i // 30 % 10}.{i % 30}.dev{i}"
+        filename = rng.choice(
+            [
+                f"ghpypi-{version}.tar.gz",
+                f"ghpypi-{version}-py3-none-any.whl",
+                f"ghpypi-{version}-cp312-cp312-manylinux_2_17_x86_64.whl",
+            ],
+        )
+        packages.append(
+            ghpypi.create_package(
+                ghpypi.Artifact(
+                    filename=filename,
+                    url=f"https://github.com/paullockaby/ghpypi/releases/download/{version}/{filename}",
+                    sha256="1234567890abcdef1234567890abcdef1234567890abcdef1234567890abcdef",
+                    uploaded_at=datetime(2020, 1, 1, 0, 0, 0),
+                    uploaded_by="github-actions[bot]",
+                ),
+            ),
+        )
+
+    rng.shuffle(packages)
+    return packages
+
+
+def measure(label: str, function: Callable[[], list[ghpypi.Package]], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    print(f"{label:<30} {best:8.3f}s")
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    packages = get_packages(args.count)
+    print(f"sorting {len(packages):,} files")
+
+    # make sure that both ways give the same answer before timing them
+    assert sorted(packages) == ghpypi.sort_packages(packages)  # noqa: S101
+
+    compared = measure("comparing packages", lambda: sorted(packages), args.repeat)
+    keyed = measure("sorting by key", lambda: ghpypi.sort_packages(packages), args.repeat)
+    print(f"sorting by key is {compared / keyed:.1f}x faster")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+"""Measure how each stage of building an index scales with the number of files.
+
+Every corpus is served by a fake GitHub on localhost and then goes through
+the same stages as a real run, one after the other, in a fresh process so
+that the peak memory of one corpus does not hide the next one.
+
+Run this with "make bench" or "poetry run python benchmarks/bench_stages.py".
+"""
+
+import argparse
+import hashlib
+import http.server
+import json
+import logging
+import multiprocessing
+import re
+import resource
+import sys
+import tempfile
+import time
+import urllib.parse
+from typing import Any, Callable, Optional
+
+import synthetic
+
+from ghpypi import ghpypi
+
+SIZES = (10, 1_000, 100_000)
+
+# stages that take less time than this are too noisy to compare
+MINIMUM_SECONDS = 0.05
+
+ROW = "{stage:<20} {files:>9,} {seconds:>9.3f} {files_per_second:>12,.0f} {peak:>8.1f}MB {increase:>8.1f}MB"
+
+# roughly what a busy organization looks like
+FILES_PER_RELEASE = 10
+FILES_PER_REPOSITORY = 1_000
+
+# this many files have no digest from github and have to be downloaded
+DOWNLOAD_EVERY = 10
+
+
+def get_content(filename: str) -> bytes:
+    return filename.encode() * 64
+
+
+def get_corpus(count: int, base_url: str) -> dict[str, list[dict[str, Any]]]:
+    # repository name -> releases as the rest api would list them
+    corpus: dict[str, list[dict[str, Any]]] = {}
+    for index, filename in enumerate(synthetic.get_filenames(count)):
+        repository = f"repo{index // FILES_PER_REPOSITORY}"
+        releases = corpus.setdefault(repository, [])
+        if index % FILES_PER_RELEASE == 0:
+            release_id = len(releases) + 1
+            releases.append(
+                {
+                    "id": release_id,
+                    "url": f"{base_url}/repos/benchmark/{repository}/releases/{release_id}",
+                    "tag_name": f"v{release_id}",
+                    "assets": [],
+                },
+            )
+
+        content = get_content(filename)
+        releases[-1]["assets"].append(
+            {
+                "id": index,
+                "name": filename,
+                "url": f"{base_url}/repos/benchmark/{repository}/releases/assets/{index}",
+                "browser_download_url": f"{base_url}/download/{index}/{urllib.parse.quote(filename)}",
+                "size": len(content),
+                "digest": None if index % DOWNLOAD_EVERY == 0 else f"sha256:{hashlib.sha256(content).hexdigest()}",
+                "updated_at": f"2021-12-25T06:{index // 60 % 60:02d}:{index % 60:02d}Z",
+                "uploader": {"login": "github-actions[bot]"},
+            },
+        )
+
+    return corpus
+
+
+class FakeGitHub(http.server.BaseHTTPRequestHandler):
+    """Serves releases and assets the way that the GitHub REST API does."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server: "FakeGitHubServer"
+
+    def do_GET(self) -> None:  # noqa: N802
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        match = re.match(r"/download/\d+/(.+)$", url.path)
+        if match:
+            self.send(get_content(urllib.parse.unquote(match.group(1))), "application/octet-stream")
+            return
+
+        match = re.match(r"/repos/benchmark/([^/]+)(/releases)?(?:/(\d+))?$", url.path)
+        releases = self.server.corpus.get(match.group(1)) if match else None
+        if match is None or releases is None:
+            self.send(b'{"message": "Not Found"}', status=404)
+            return
+
+        repository, listing, release_id = match.groups()
+        if release_id is not None:
+            self.send(json.dumps(releases[int(release_id) - 1]).encode())
+        elif listing is None:
+            self.send(json.dumps({"name": repository, "full_name": f"benchmark/{repository}"}).encode())
+        else:
+            per_page = int(query.get("per_page", ["30"])[0])
+            page = int(query.get("page", ["1"])[0])
+            begin, stop = (page - 1) * per_page, page * per_page
+            link = None
+            if stop < len(releases):
+                link = f'<{self.server.base_url}{url.path}?per_page={per_page}&page={page + 1}>; rel="next"'
+            self.send(json.dumps(releases[begin:stop]).encode(), link=link)
+
+    def send(
+        self,
+        body: bytes,
+        content_type: str = "application/json",
+        status: int = 200,
+        link: Optional[str] = None,
+    ) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if link is not None:
+            self.send_header("Link", link)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+
+class FakeGitHubServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    # repository name -> releases, which is changed for every corpus
+    corpus: dict[str, list[dict[str, Any]]]
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host!s}:{port}"
+
+
+def serve(count: int, connection: Any) -> None:
+    server = FakeGitHubServer(("127.0.0.1", 0), FakeGitHub)
+    server.corpus = get_corpus(count, server.base_url)
+    connection.send((server.base_url, sorted(server.corpus)))
+    server.serve_forever()
+
+
+def get_peak_rss() -> int:
+    # linux reports kilobytes and macos reports bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_stages(base_url: str, repositories: list[str], count: int) -> list[dict[str, Any]]:
+    # this runs in its own process so that the peak rss is just for this corpus
+    logging.basicConfig(level=logging.ERROR)
+
+    results = []
+    state: dict[str, Any] = {}
+
+    def measure(stage: str, function: Callable[[], Any]) -> None:
+        before = get_peak_rss()
+        start = time.perf_counter()
+        state[stage] = function()
+        elapsed = time.perf_counter() - start
+        peak = get_peak_rss()
+        results.append(
+            {
+                "stage": stage,
+                "files": count,
+                "seconds": elapsed,
+                "files_per_second": count / elapsed if elapsed else 0.0,
+                "peak_rss": peak,
+                "peak_rss_increase": peak - before,
+            },
+        )
+
+    # the real client waits between requests to github, which would be all
+    # that we measured here
+    with (
+        ghpypi.Client("benchmark", pool_size=16, request_interval=0, base_url=base_url) as client,
+        tempfile.TemporaryDirectory() as output,
+    ):
+
+        def fetch() -> list[ghpypi.Artifact]:
+            cache = ghpypi.Cache()
+            return [
+                artifact
+                for name in repositories
+                for artifact in ghpypi.get_artifacts(client, ghpypi.Repository("benchmark", name), cache)
+            ]
+
+        measure("fetch", fetch)
+        measure("create_packages", lambda: ghpypi.create_packages(state["fetch"]))
+        measure("sort", lambda: {k: ghpypi.sort_packages(v) for k, v in state["create_packages"].items()})
+        measure("get_package_json", lambda: [ghpypi.get_package_json(v) for v in state["sort"].values()])
+        measure("build", lambda: ghpypi.build(state["create_packages"], output, "Benchmark", jobs=4))
+
+    return results
+
+
+def compare(results: list[dict[str, Any]], path: str, tolerance: float) -> bool:
+    # a stage has regressed if it got slower than the baseline by more than the tolerance
+    with open(path) as f:
+        baseline = {(x["stage"], x["files"]): x for x in json.load(f)["results"]}
+
+    ok = True
+    for result in results:
+        previous = baseline.get((result["stage"], result["files"]))
+        if previous is None or min(previous["seconds"], result["seconds"]) < MINIMUM_SECONDS:
+            continue
+
+        change = result["files_per_second"] / previous["files_per_second"] - 1
+        if change < -tolerance:
+            print(f"{result['stage']} with {result['files']:,} files is {-change:.0%} slower than the baseline")
+            ok = False
+
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    parser.add_argument("--json", metavar="PATH", help="write the results to this file")
+    parser.add_argument("--baseline", metavar="PATH", help="fail if anything is slower than in this results file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="how much slower is still ok (default: 0.25)")
+    args = parser.parse_args()
+
+    # a fresh interpreter for every corpus, not a fork of this one
+    context = multiprocessing.get_context("spawn")
+
+    results = []
+    print(f"{'stage':<20} {'files':>9} {'seconds':>9} {'files/s':>12} {'peak rss':>10} {'increase':>10}")
+    for size in args.sizes:
+        # the server gets a process of its own so that the corpus it holds
+        # is not counted against the stages
+        receiver, sender = context.Pipe(duplex=False)
+        server = context.Process(target=serve, args=(size, sender), daemon=True)
+        server.start()
+        try:
+            base_url, repositories = receiver.recv()
+            with context.Pool(1) as pool:
+                for result in pool.apply(run_stages, (base_url, repositories, size)):
+                    print(
+                        ROW.format(
+                            peak=result["peak_rss"] / 1024 / 1024,
+                            increase=result["peak_rss_increase"] / 1024 / 1024,
+                            **result,
+                        ),
+                    )
+                    results.append(result)
+        finally:
+            server.terminate()
+            server.join()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"version": ghpypi.get_version("ghpypi"), "results": results}, f, indent=2)
+
+    if args.baseline and not compare(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""Made up file names for the benchmarks to chew on."""
+
+import random
+import re
+
+NAMES = ["ghpypi", "Aspy.Yaml", "my_package", "python-dateutil", "zope.interface", "Flask-SQLAlchemy"]
+VERSIONS = ["{}.{}.{}", "{}.{}.{}rc1", "{}.{}.{}.post1", "{}.{}.{}.dev2", "1!{}.{}.{}", "{}.{}.{}+local.7"]
+TEMPLATES = [
+    "{name}-{version}-py3-none-any.whl",
+    "{name}-{version}-cp312-cp312-manylinux_2_17_x86_64.manylinux2014_x86_64.whl",
+    "{name}-{version}.tar.gz",
+    "{name}-{version}.zip",
+    "{name}-{version}-1.tar.bz2",
+    "{name}-cli-{version}.tar.gz",
+    "{name}.yaml-{version}.tgz",
+]
+
+# roughly what a busy organization looks like
+FILES_PER_PACKAGE = 25
+
+
+def get_filenames(count: int, seed: int = 0, files_per_package: int = FILES_PER_PACKAGE) -> list[str]:
+    # lots of files across lots of packages, with the sorts of sdist names
+    # that are hard to parse and the odd one that can't be parsed at all
+    rng = random.Random(seed)  # noqa: S311
+    packages = max(1, count // files_per_package)
+    filenames: set[str] = set()
+    while len(filenames) < count:
+        if rng.randrange(1000) == 0:
+            filenames.add(f"{rng.choice(NAMES)}-latest-{len(filenames)}.tar.gz")
+            continue
+
+        name = f"{rng.choice(NAMES)}{rng.randrange(packages)}"
+        version = rng.choice(VERSIONS).format(rng.randrange(10), rng.randrange(100), rng.randrange(1000))
+        template = rng.choice(TEMPLATES)
+        if template.endswith(".whl"):
+            name = re.sub(r"[-.]", "_", name)
+        filenames.add(template.format(name=name, version=version))
+
+    # in no particular order, like they come from github
+    return sorted(filenames, key=lambda _: rng.random())
@@ -49,6 +49,156 @@ def parse_arguments(arguments: List[str]) -> argparse.Namespace:
         default=False,
         help="if multiple packages with the same name are found, merge them -- you probably do NOT want to set this",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        metavar="N",
+        dest="jobs",
+        type=int,
+        default=1,
+        help="number of repositories to fetch concurrently",
+    )
+    parser.add_argument(
+        "--download-jobs",
+        metavar="N",
+        dest="download_jobs",
+        type=int,
+        default=4,
+        help="number of files to download at once when calculating digests",
+    )
+    parser.add_argument(
+        "--build-jobs",
+        metavar="N",
+        dest="build_jobs",
+        type=int,
+        default=1,
+        help="number of packages to render and write at once",
+    )
+    parser.add_argument(
+        "--shard-index",
+        dest="shard_index",
+        action="store_true",
+        default=False,
+        help="split the front page up by letter and search a prebuilt index -- useful with thousands of packages",
+    )
+    parser.add_argument(
+        "--precompress",
+        dest="precompress",
+        action="store_true",
+        default=False,
+        help="write .gz (and .br if brotli is installed) copies of every page for static web servers to send",
+    )
+    parser.add_argument(
+        "--upload-metadata",
+        dest="upload_metadata",
+        action="store_true",
+        default=False,
+        help="attach the core metadata from wheels that we download to their releases -- needs write access",
+    )
+    parser.add_argument(
+        "--stream",
+        dest="stream",
+        action="store_true",
+        default=False,
+        help="keep packages on disk until they are written instead of in memory -- useful with huge indexes",
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        default=False,
+        help="fetch everything for every repository at once using asyncio instead of using --jobs and --download-jobs",
+    )
+    parser.add_argument(
+        "--async-requests",
+        metavar="N",
+        dest="async_requests",
+        type=int,
+        default=32,
+        help="number of requests to have in flight at once when using --async",
+    )
+    parser.add_argument(
+        "--async-host-requests",
+        metavar="N",
+        dest="async_host_requests",
+        type=int,
+        default=8,
+        help="number of requests to have in flight at once to any one host when using --async",
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="PATH",
+        dest="cache",
+        default=None,
+        help="path to a file used to remember file digests and release listings between runs",
+    )
+    parser.add_argument(
+        "--incremental",
+        dest="incremental",
+        action="store_true",
+        default=False,
+        help="only rewrite pages for packages that changed since the last build and remove pages for packages that are gone",
+    )
+    parser.add_argument(
+        "--backend",
+        dest="backend",
+        choices=["rest", "graphql"],
+        default="rest",
+        help="how to list releases -- graphql lists many repositories in a single request",
+    )
+    parser.add_argument(
+        "--pool-size",
+        metavar="N",
+        dest="pool_size",
+        type=int,
+        default=None,
+        help="number of connections to keep open to each host (defaults to enough for the number of jobs or requests)",
+    )
+    parser.add_argument(
+        "--request-interval",
+        metavar="SECONDS",
+        dest="request_interval",
+        type=float,
+        default=None,
+        help="time to leave between requests to the github api across all jobs (defaults to 0.25 divided by --jobs)",
+    )
+    parser.add_argument(
+        "--retries",
+        metavar="N",
+        dest="retries",
+        type=int,
+        default=3,
+        help="number of times to retry a failed request",
+    )
+    parser.add_argument(
+        "--backoff",
+        metavar="SECONDS",
+        dest="backoff",
+        type=float,
+        default=0.5,
+        help="backoff factor between retries of a failed request",
+    )
+    parser.add_argument(
+        "--stats-json",
+        metavar="PATH",
+        dest="stats_json",
+        default=None,
+        help="write counters and how long each phase took to this file as json when the run is over",
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="PATH_OR_URL",
+        dest="metrics",
+        default=None,
+        help="write prometheus metrics to this .prom file for the textfile collector, or push them to this pushgateway",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        dest="profile",
+        default=None,
+        help="write cProfile statistics for the run to this file -- view them with pstats or snakeviz",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -82,6 +232,26 @@ def main() -> None:
         args.token_stdin,
         args.title,
         args.merge_duplicates,
+        args.jobs,
+        args.cache,
+        args.incremental,
+        args.backend,
+        args.pool_size,
+        args.retries,
+        args.backoff,
+        args.download_jobs,
+        args.build_jobs,
+        args.shard_index,
+        args.use_async,
+        args.async_requests,
+        args.async_host_requests,
+        args.precompress,
+        args.upload_metadata,
+        args.stream,
+        args.stats_json,
+        args.profile,
+        args.metrics,
+        args.request_interval,
     )
 
 
@@ -1,13 +1,43 @@
+import asyncio
 import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import functools
+import gzip
 import hashlib
 import importlib.metadata
+import io
+import itertools
 import json
 import logging
+import operator
 import os.path
 import re
+import shutil
+import sqlite3
 import sys
-from datetime import datetime
-from typing import Any, Iterator, NamedTuple, Optional, cast
+import tempfile
+import threading
+import time
+import urllib.parse
+import zipfile
+from datetime import datetime, timedelta, timezone
+from typing import (
+    IO,
+    Any,
+    Callable,
+    ClassVar,
+    Iterable,
+    Iterator,
+    Mapping,
+    MutableMapping,
+    NamedTuple,
+    Optional,
+    TypeVar,
+    Union,
+    cast,
+)
 
 import distlib.wheel  # type: ignore
 import github
@@ -15,10 +45,20 @@ import jinja2
 import packaging.utils
 import packaging.version
 import requests
+import requests.adapters
+import requests.utils
+import urllib3.util
 from atomicwrites import atomic_write
 
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
+
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 
 def get_version(package_name: str = __name__) -> str:
     try:
@@ -69,36 +109,198 @@ def guess_name_version_from_filename(filename: str) -> tuple[str, Optional[str]]
     return name, version
 
 
+# filenames never change what they parse to so there is no point in parsing
+# the same one twice. this is big enough for a very large index.
+FILENAME_CACHE_SIZE = 256 * 1024
+
+
+@functools.lru_cache(maxsize=FILENAME_CACHE_SIZE)
+def parse_filename(filename: str) -> tuple[str, packaging.version.Version]:
+    name, version = guess_name_version_from_filename(filename)
+    return packaging.utils.canonicalize_name(name), packaging.version.parse(version or "0")
+
+
 class Repository(NamedTuple):
     owner: str
     name: str
 
 
-class Artifact(NamedTuple):
-    filename: str
-    url: str
-    sha256: str
-    uploaded_at: datetime
-    uploaded_by: str
+# release asset urls all start the same way for every file in a release
+# and digests are much smaller as bytes than as hex so records keep them like
+# that and turn them back into what everybody expects when they are asked
+EPOCH = datetime(1970, 1, 1)
+
+
+def pack_digest(digest: Optional[str]) -> Union[bytes, str, None]:
+    if digest is not None and len(digest) == 64 and re.match(r"[a-f\d]{64}$", digest):
+        return bytes.fromhex(digest)
+    return digest
+
+
+def unpack_digest(digest: Union[bytes, str, None]) -> Optional[str]:
+    return digest.hex() if isinstance(digest, bytes) else digest
+
+
+def pack_timestamp(value: datetime) -> Union[int, datetime]:
+    # anything that would not come back exactly the same is kept as it is
+    if value.tzinfo is None and value.microsecond == 0:
+        return int((value - EPOCH).total_seconds())
+    return value
+
+
+def unpack_timestamp(value: Union[int, datetime]) -> datetime:
+    return EPOCH + timedelta(seconds=value) if isinstance(value, int) else value
+
+
+def intern(value: Optional[str]) -> Optional[str]:
+    return None if value is None else sys.intern(value)
+
+
+class Record:
+    """A compact, immutable record that looks like a named tuple to everybody that uses it."""
+
+    __slots__ = ("filename", "_url_prefix", "_url_suffix", "_sha256", "_uploaded_at", "uploaded_by", "_metadata_sha256")
 
+    # these are the names of the fields in the order that they are given to us
+    _fields: tuple[str, ...] = ()
+
+    # this gets everything that makes a record what it is in one go
+    _get_key: ClassVar[Callable[[Any], tuple[object, ...]]]
+
+    def __init_subclass__(cls: type["Record"]) -> None:
+        super().__init_subclass__()
+        slots = [slot for klass in reversed(cls.__mro__) for slot in getattr(klass, "__slots__", ())]
+        cls._get_key = operator.attrgetter(*slots)
 
-class Package(NamedTuple):
     filename: str
-    url: str
-    sha256: str
-    uploaded_at: datetime
     uploaded_by: str
+    _url_prefix: str
+    _url_suffix: str
+    _sha256: Union[bytes, str, None]
+    _uploaded_at: Union[int, datetime]
+    _metadata_sha256: Union[bytes, str, None]
+
+    def __init__(
+        self: "Record",
+        filename: str,
+        url: str,
+        sha256: str,
+        uploaded_at: datetime,
+        uploaded_by: str,
+        metadata_sha256: Optional[str] = None,
+    ) -> None:
+        set_slot = object.__setattr__
+        set_slot(self, "filename", filename)
+
+        # usually the url is the same for every file in a release up until
+        # the file name so all of the files share one copy of that part
+        if url.endswith(filename):
+            set_slot(self, "_url_prefix", sys.intern(url[: len(url) - len(filename)]))
+            set_slot(self, "_url_suffix", filename)
+        else:
+            set_slot(self, "_url_prefix", url)
+            set_slot(self, "_url_suffix", "")
+
+        set_slot(self, "_sha256", pack_digest(sha256))
+        set_slot(self, "_uploaded_at", pack_timestamp(uploaded_at))
+        set_slot(self, "uploaded_by", intern(uploaded_by))
+        set_slot(self, "_metadata_sha256", pack_digest(metadata_sha256))
+
+    @property
+    def url(self: "Record") -> str:
+        return self._url_prefix + self._url_suffix
+
+    @property
+    def sha256(self: "Record") -> str:
+        return cast(str, unpack_digest(self._sha256))
+
+    @property
+    def uploaded_at(self: "Record") -> datetime:
+        return unpack_timestamp(self._uploaded_at)
+
+    @property
+    def metadata_sha256(self: "Record") -> Optional[str]:
+        return unpack_digest(self._metadata_sha256)
+
+    def __setattr__(self: "Record", name: str, value: object) -> None:
+        raise AttributeError(f"can't set attribute {name!r}")
+
+    def __delattr__(self: "Record", name: str) -> None:
+        raise AttributeError(f"can't delete attribute {name!r}")
+
+    def __eq__(self: "Record", other: object) -> bool:
+        if type(self) is not type(other):
+            return NotImplemented
+        return type(self)._get_key(self) == type(self)._get_key(other)
+
+    def __hash__(self: "Record") -> int:
+        return hash(type(self)._get_key(self))
+
+    def __repr__(self: "Record") -> str:
+        values = ", ".join(f"{name}={value!r}" for name, value in self._asdict().items())
+        return f"{type(self).__name__}({values})"
+
+    def __reduce__(self: "Record") -> tuple[type["Record"], tuple[Any, ...]]:
+        # pickling and copying would otherwise try to set our slots one by one
+        return type(self), tuple(getattr(self, name) for name in self._fields)
+
+    def _asdict(self: "Record") -> dict[str, Any]:
+        return {name: getattr(self, name) for name in self._fields}
+
+    def _replace(self: T, **kwargs: Any) -> T:
+        return type(self)(**{**cast(Record, self)._asdict(), **kwargs})
 
-    # the above fields all come from the artifact
-    # these fields get calculated by whatever creates us
+
+class Artifact(Record):
+    # the metadata digest is of the core metadata file published next to a wheel
+    __slots__ = ()
+    _fields = ("filename", "url", "sha256", "uploaded_at", "uploaded_by", "metadata_sha256")
+
+
+class Package(Record):
+    __slots__ = ("name", "version")
+    _fields = ("filename", "url", "sha256", "uploaded_at", "uploaded_by", "name", "version", "metadata_sha256")
+
+    # these fields get calculated by whatever creates us, the rest of them
+    # come from the artifact
     name: str
     version: packaging.version.Version
 
+    def __init__(
+        self: "Package",
+        filename: str,
+        url: str,
+        sha256: str,
+        uploaded_at: datetime,
+        uploaded_by: str,
+        name: str,
+        version: packaging.version.Version,
+        metadata_sha256: Optional[str] = None,
+    ) -> None:
+        super().__init__(filename, url, sha256, uploaded_at, uploaded_by, metadata_sha256)
+        object.__setattr__(self, "name", sys.intern(name))
+        object.__setattr__(self, "version", version)
+
+    @classmethod
+    def from_artifact(
+        cls: type["Package"],
+        artifact: Artifact,
+        name: str,
+        version: packaging.version.Version,
+    ) -> "Package":
+        # this skips packing everything from the artifact all over again
+        package = cls.__new__(cls)
+        for slot in Record.__slots__:
+            object.__setattr__(package, slot, getattr(artifact, slot))
+        object.__setattr__(package, "name", sys.intern(name))
+        object.__setattr__(package, "version", version)
+        return package
+
     def __str__(self: "Package") -> str:
         return f"{self.version}, {self.uploaded_at.strftime('%Y-%m-%d %H:%M:%S')}, {self.uploaded_by}"  # noqa Q000
 
-    def __lt__(self: tuple[object, ...], other: tuple[object, ...]) -> bool:
-        return cast("Package", self).sort_key < cast("Package", other).sort_key
+    def __lt__(self: "Package", other: "Package") -> bool:
+        return self.sort_key < other.sort_key
 
     @property
     def sort_key(
@@ -118,6 +320,338 @@ class Package(NamedTuple):
         )
 
 
+def sort_packages(files: Iterable[Package]) -> list[Package]:
+    # this builds the sort key once per file instead of twice per comparison
+    return sorted(files, key=operator.attrgetter("sort_key"))
+
+
+class Statistics:
+    """Counters and timers that are collected over the course of a run."""
+
+    def __init__(self: "Statistics") -> None:
+        self.counters: collections.Counter[str] = collections.Counter()
+
+        # seconds spent in each phase. phases that run in more than one
+        # thread at a time add up the time from every thread.
+        self.timers: dict[str, float] = collections.defaultdict(float)
+
+        # how long each repository took to fetch and how many files it had
+        self.repositories: dict[str, dict[str, float]] = {}
+
+        # repositories may be fetched concurrently
+        self.lock = threading.Lock()
+
+    def increment(self: "Statistics", name: str, value: int = 1) -> None:
+        with self.lock:
+            self.counters[name] += value
+
+    def add_time(self: "Statistics", name: str, seconds: float) -> None:
+        with self.lock:
+            self.timers[name] += seconds
+
+    def add_repository(self: "Statistics", repository: Repository, seconds: float, files: int) -> None:
+        with self.lock:
+            self.repositories[f"{repository.owner}/{repository.name}"] = {"seconds": seconds, "files": files}
+
+    @contextlib.contextmanager
+    def timer(self: "Statistics", name: str) -> Iterator[None]:
+        # this works as a decorator too
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def reset(self: "Statistics") -> None:
+        with self.lock:
+            self.counters.clear()
+            self.timers.clear()
+            self.repositories.clear()
+
+    def as_dict(self: "Statistics") -> dict[str, Any]:
+        with self.lock:
+            return {
+                "counters": dict(sorted(self.counters.items())),
+                "timers": {name: round(seconds, 6) for name, seconds in sorted(self.timers.items())},
+                "repositories": {
+                    name: {"seconds": round(entry["seconds"], 6), "files": entry["files"]}
+                    for name, entry in sorted(self.repositories.items())
+                },
+            }
+
+    def save(self: "Statistics", path: str, success: bool = True) -> None:
+        data: dict[str, Any] = {
+            "version": get_version("ghpypi"),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "success": success,
+        }
+        data.update(self.as_dict())
+        with atomic_write(path, overwrite=True) as f:
+            json.dump(data, f, indent=2)
+            f.write("\n")
+
+
+# this is shared by everything that runs in this process
+statistics = Statistics()
+
+# counters that are really one metric with a label
+PROMETHEUS_LABELS = {
+    "digests_from_": ("digests", "source"),
+    "rate_limit_used_": ("rate_limit_used", "resource"),
+    "rate_limit_remaining_": ("rate_limit_remaining", "resource"),
+}
+
+PROMETHEUS_HELP = {
+    "run_success": "Whether the last run finished without an error",
+    "last_run_timestamp_seconds": "When the last run finished",
+    "run_duration_seconds": "How long the last run took",
+    "phase_seconds": "Seconds spent in each phase, added up across threads",
+    "repository_fetch_seconds": "How long it took to fetch the releases and digests for each repository",
+    "repository_files": "How many package files each repository has",
+    "digests": "Where the digest for each file came from",
+    "download_bytes": "Bytes downloaded to calculate digests",
+    "download_bytes_avoided": "Bytes that did not have to be downloaded because the digest was already known",
+    "files_written": "Files written to the index",
+    "packages_skipped": "Packages that had not changed and were not written",
+    "http_requests": "Requests made outside of the GitHub API client",
+    "rate_limit_used": "GitHub API requests used from each rate limit",
+    "rate_limit_remaining": "GitHub API requests left in each rate limit",
+}
+
+
+def format_prometheus_labels(labels: Mapping[str, str]) -> str:
+    if not labels:
+        return ""
+
+    def escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def get_prometheus_metrics(data: Mapping[str, Any], success: bool = True) -> str:
+    # https://prometheus.io/docs/instrumenting/exposition_formats/
+    # everything is a gauge because every run starts counting from zero
+    samples: dict[str, list[tuple[dict[str, str], float]]] = collections.defaultdict(list)
+    samples["run_success"].append(({}, int(success)))
+    samples["last_run_timestamp_seconds"].append(({}, round(time.time(), 3)))
+
+    for name, value in data["counters"].items():
+        for prefix, (metric, label) in PROMETHEUS_LABELS.items():
+            if name.startswith(prefix):
+                samples[metric].append(({label: name.removeprefix(prefix)}, value))
+                break
+        else:
+            samples[name].append(({}, value))
+
+    for name, seconds in data["timers"].items():
+        if name == "total":
+            samples["run_duration_seconds"].append(({}, seconds))
+        else:
+            samples["phase_seconds"].append(({"phase": name}, seconds))
+
+    for name, entry in data["repositories"].items():
+        samples["repository_fetch_seconds"].append(({"repository": name}, entry["seconds"]))
+        samples["repository_files"].append(({"repository": name}, entry["files"]))
+
+    lines = []
+    for metric, values in samples.items():
+        name = f"ghpypi_{metric}"
+        lines.append(f"# HELP {name} {PROMETHEUS_HELP.get(metric, metric.replace('_', ' ').capitalize())}.")
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(f"{name}{format_prometheus_labels(labels)} {value}" for labels, value in values)
+
+    return "\n".join(lines) + "\n"
+
+
+def save_prometheus_metrics(target: str, data: Mapping[str, Any], success: bool = True) -> None:
+    text = get_prometheus_metrics(data, success)
+
+    # urls are pushed to a pushgateway and anything else is a file for the
+    # node exporter textfile collector, which must never see half of a file
+    if not target.startswith(("http://", "https://")):
+        with atomic_write(target, overwrite=True) as f:
+            f.write(text)
+        return
+
+    if "/metrics/job/" not in target:
+        target = target.rstrip("/") + "/metrics/job/ghpypi"
+    response = requests.put(
+        target,
+        data=text.encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        timeout=10,
+    )
+    response.raise_for_status()
+
+
+class Cache:
+    """Persists digests and release listings between runs so that unchanged things are not fetched again."""
+
+    # bump this whenever the format of the cache file changes
+    VERSION = 1
+
+    def __init__(self: "Cache", path: Optional[str] = None, metadata: bool = False) -> None:
+        self.path = path
+        self.digests: dict[str, dict[str, Any]] = {}
+        self.releases: dict[str, dict[str, Any]] = {}
+
+        # the core metadata that we find in wheels, by the digest of the
+        # wheel, if anybody wants it. this is only kept for this run.
+        self.metadata: Optional[dict[str, bytes]] = {} if metadata else None
+
+        # keep track of every entry that we touched during this run so that
+        # entries for assets and repositories that no longer exist can be
+        # evicted on save
+        self.seen_digests: set[str] = set()
+        self.seen_releases: set[str] = set()
+
+        # repositories may be fetched concurrently
+        self.lock = threading.Lock()
+
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def load(self: "Cache") -> None:
+        try:
+            with open(cast(str, self.path), "rt", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("unable to read cache file %s: %s (ignoring cache)", self.path, e)
+            return
+
+        if not isinstance(data, dict) or data.get("version") != self.VERSION:
+            logger.warning("cache file %s has an unknown format (ignoring cache)", self.path)
+            return
+
+        self.digests = data.get("digests") or {}
+        self.releases = data.get("releases") or {}
+        logger.debug(
+            "loaded %d digests and %d release listings from %s",
+            len(self.digests),
+            len(self.releases),
+            self.path,
+        )
+
+    def save(self: "Cache") -> None:
+        if self.path is None:
+            return
+
+        with self.lock:
+            evicted = len(self.digests.keys() - self.seen_digests) + len(self.releases.keys() - self.seen_releases)
+            self.digests = {key: value for key, value in self.digests.items() if key in self.seen_digests}
+            self.releases = {key: value for key, value in self.releases.items() if key in self.seen_releases}
+            data = {"version": self.VERSION, "digests": self.digests, "releases": self.releases}
+
+        logger.info(
+            "saving %d digests and %d release listings to %s (evicted %d)",
+            len(self.digests),
+            len(self.releases),
+            self.path,
+            evicted,
+        )
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with atomic_write(self.path, overwrite=True) as f:
+            json.dump(data, f, sort_keys=True)
+
+    @staticmethod
+    def get_digest_key(asset: dict) -> str:
+        # asset ids are stable across renames but fall back to the url for
+        # assets that do not have one
+        return str(asset.get("id") or asset["browser_download_url"])
+
+    @staticmethod
+    def get_digest_entry(asset: dict) -> dict[str, Any]:
+        return {
+            "url": asset["browser_download_url"],
+            "size": asset.get("size"),
+            "updated_at": asset.get("updated_at"),
+        }
+
+    def get_digest(self: "Cache", asset: dict) -> Optional[str]:
+        key = self.get_digest_key(asset)
+        with self.lock:
+            self.seen_digests.add(key)
+            entry = self.digests.get(key)
+
+        # only trust the digest if the asset has not been replaced
+        if entry is None or {k: entry.get(k) for k in ("url", "size", "updated_at")} != self.get_digest_entry(asset):
+            return None
+
+        return cast(Optional[str], entry.get("sha256"))
+
+    def set_digest(self: "Cache", asset: dict, sha256: str) -> None:
+        key = self.get_digest_key(asset)
+        with self.lock:
+            self.seen_digests.add(key)
+            self.digests[key] = {**self.get_digest_entry(asset), "sha256": sha256}
+
+    def wants_metadata(self: "Cache") -> bool:
+        return self.metadata is not None
+
+    def get_metadata(self: "Cache", sha256: str) -> Optional[bytes]:
+        with self.lock:
+            return None if self.metadata is None else self.metadata.get(sha256)
+
+    def set_metadata(self: "Cache", sha256: str, data: bytes) -> None:
+        with self.lock:
+            if self.metadata is not None:
+                self.metadata[sha256] = data
+
+    def get_releases(self: "Cache", repository: Repository) -> Optional[tuple[str, list[Artifact]]]:
+        key = f"{repository.owner}/{repository.name}"
+        with self.lock:
+            self.seen_releases.add(key)
+            entry = self.releases.get(key)
+
+        if entry is None:
+            return None
+
+        artifacts = [
+            Artifact(
+                filename=x["filename"],
+                url=x["url"],
+                sha256=x["sha256"],
+                uploaded_at=datetime.fromisoformat(x["uploaded_at"]),
+                uploaded_by=x["uploaded_by"],
+                metadata_sha256=x.get("metadata_sha256"),
+            )
+            for x in entry["artifacts"]
+        ]
+
+        # the digests for these artifacts are still in use even though we will
+        # not be looking at them again so make sure they are not evicted
+        with self.lock:
+            self.seen_digests.update(entry["digests"])
+
+        return entry["etag"], artifacts
+
+    def get_release_count(self: "Cache", repository: Repository) -> Optional[int]:
+        with self.lock:
+            entry = self.releases.get(f"{repository.owner}/{repository.name}")
+        return None if entry is None else entry.get("count")
+
+    def set_releases(
+        self: "Cache",
+        repository: Repository,
+        etag: str,
+        artifacts: list[Artifact],
+        digests: list[str],
+        count: int = 0,
+    ) -> None:
+        key = f"{repository.owner}/{repository.name}"
+        with self.lock:
+            self.seen_releases.add(key)
+            self.releases[key] = {
+                "etag": etag,
+                "count": count,
+                "artifacts": [{**x._asdict(), "uploaded_at": x.uploaded_at.isoformat()} for x in artifacts],
+                "digests": digests,
+            }
+
+
 def get_package_json(files: list[Package]) -> dict[str, Any]:
     # https://warehouse.pypa.io/api-reference/json.html
     # note: the full api contains much more, we only output the info we have
@@ -143,64 +677,408 @@ def get_package_json(files: list[Package]) -> dict[str, Any]:
     }
 
 
-def build(packages: dict[str, set[Package]], output: str, title: str) -> None:
-    simple = os.path.join(output, "simple")
-    pypi = os.path.join(output, "pypi")
+# https://peps.python.org/pep-0691/
+SIMPLE_API_VERSION = "1.0"
+
+
+def get_simple_json(package_name: str, files: list[Package]) -> dict[str, Any]:
+    # this is the json version of /simple/{package}/index.html
+    return {
+        "meta": {"api-version": SIMPLE_API_VERSION},
+        "name": package_name,
+        "files": [get_simple_file_json(f) for f in files],
+    }
+
+
+def get_simple_file_json(f: Package) -> dict[str, Any]:
+    result: dict[str, Any] = {
+        "filename": f.filename,
+        "url": f.url,
+        "hashes": {"sha256": f.sha256} if f.sha256 else {},
+    }
+
+    # https://peps.python.org/pep-0714/ renamed the key from pep 658 but
+    # older clients still look for the old name so we give them both
+    if f.metadata_sha256:
+        result["core-metadata"] = {"sha256": f.metadata_sha256}
+        result["dist-info-metadata"] = {"sha256": f.metadata_sha256}
+
+    return result
+
+
+def get_simple_index_json(package_names: Iterable[str]) -> dict[str, Any]:
+    # this is the json version of /simple/index.html
+    return {
+        "meta": {"api-version": SIMPLE_API_VERSION},
+        "projects": [{"name": name} for name in package_names],
+    }
+
+
+# the manifest records what we built last time so that we can skip packages that have not changed
+MANIFEST_FILENAME = ".ghpypi-manifest.json"
+MANIFEST_VERSION = 1
+
+
+def get_package_digest(
+    package_name: str,
+    sorted_files: list[Package],
+    precompress: bool = False,
+) -> str:
+    # anything that changes what we write for a package needs to be in here,
+    # including the version of this program since the templates may change.
+    # the title is only on the indexes, which are written every time anyway.
+    hasher = hashlib.sha256()
+    hasher.update(
+        json.dumps(
+            [
+                get_version("ghpypi"),
+                precompress,
+                package_name,
+                [
+                    [f.filename, f.url, f.sha256, f.uploaded_at.isoformat(), f.uploaded_by, f.metadata_sha256]
+                    for f in sorted_files
+                ],
+            ],
+        ).encode("utf-8"),
+    )
+    return hasher.hexdigest()
+
+
+def load_manifest(output: str) -> dict[str, dict[str, Any]]:
+    path = os.path.join(output, MANIFEST_FILENAME)
+    if not os.path.exists(path):
+        return {}
+
+    try:
+        with open(path, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning("unable to read manifest %s: %s (rebuilding everything)", path, e)
+        return {}
+
+    if not isinstance(data, dict) or data.get("version") != MANIFEST_VERSION:
+        logger.warning("manifest %s has an unknown format (rebuilding everything)", path)
+        return {}
+
+    return cast(dict[str, dict[str, Any]], data.get("packages") or {})
+
+
+def save_manifest(output: str, manifest: dict[str, dict[str, Any]]) -> None:
+    with atomic_write(os.path.join(output, MANIFEST_FILENAME), overwrite=True) as f:
+        json.dump({"version": MANIFEST_VERSION, "packages": manifest}, f, sort_keys=True)
+
+
+def remove_package(output: str, package_name: str, paths: list[str]) -> None:
+    logger.info("removing %s", package_name)
+
+    for path in paths:
+        path = os.path.join(output, path)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+        # clean up the package directory if we were the last thing in it
+        with contextlib.suppress(OSError):
+            os.rmdir(os.path.dirname(path))
+
+
+COMPRESS_CHUNK_SIZE = 1024 * 1024
+
 
-    jinja_env = jinja2.Environment(
+def get_file_digest(f: IO[bytes]) -> str:
+    hasher = hashlib.sha256()
+    for chunk in iter(functools.partial(f.read, COMPRESS_CHUNK_SIZE), b""):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+@statistics.timer("compress")
+def precompress_file(path: str) -> list[str]:
+    # write compressed copies of a file next to it so that static web servers
+    # can send them without compressing anything on every request. returns
+    # the suffixes of the copies that exist.
+    suffixes = [".gz"]
+    if brotli is not None:
+        suffixes.append(".br")
+
+    with open(path, "rb") as src:
+        digest = get_file_digest(src)
+
+    # compression is slow so we skip it when the file has not changed, which
+    # is the case for most of the index every time that we run. the gzip copy
+    # is cheap to decompress so it tells us what the copies were made from.
+    if all(os.path.exists(path + suffix) for suffix in suffixes):
+        try:
+            with gzip.open(path + ".gz", "rb") as f:
+                previous = get_file_digest(cast(IO[bytes], f))
+        except (OSError, EOFError) as e:
+            logger.debug("unable to read %s.gz: %s", path, e)
+        else:
+            if previous == digest:
+                statistics.increment("files_compression_skipped")
+                return suffixes
+
+    with open(path, "rb") as src:
+        # no file name or modification time in the header so that the same
+        # input always gives the same output
+        with (
+            atomic_write(path + ".gz", mode="wb", overwrite=True) as dst,
+            gzip.GzipFile(filename="", mode="wb", fileobj=dst, compresslevel=9, mtime=0) as gz,
+        ):
+            shutil.copyfileobj(src, gz, COMPRESS_CHUNK_SIZE)
+
+        if brotli is not None:
+            src.seek(0)
+            compressor = brotli.Compressor()
+            with atomic_write(path + ".br", mode="wb", overwrite=True) as dst:
+                for chunk in iter(functools.partial(src.read, COMPRESS_CHUNK_SIZE), b""):
+                    dst.write(compressor.process(chunk))
+                dst.write(compressor.finish())
+
+    statistics.increment("files_compressed")
+    return suffixes
+
+
+def remove_compressed_copies(path: str) -> None:
+    # a web server would send these instead of the file if we left them around
+    for suffix in (".gz", ".br"):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path + suffix)
+
+
+@functools.lru_cache(maxsize=None)
+def get_jinja_env() -> jinja2.Environment:
+    # this is shared by every build in this process. our templates never
+    # change while we are running so they are only loaded and compiled once,
+    # and the compiled templates are cached on disk for the next process.
+    try:
+        bytecode_cache = jinja2.FileSystemBytecodeCache()
+    except (OSError, RuntimeError) as e:
+        logger.debug("not caching compiled templates: %s", e)
+        bytecode_cache = None
+
+    return jinja2.Environment(
         loader=jinja2.PackageLoader("ghpypi", "templates"),
         autoescape=True,
+        auto_reload=False,
+        bytecode_cache=bytecode_cache,
     )
-    jinja_env.globals["title"] = title
 
-    # sorting package versions is actually pretty expensive, so we do it once at the start
-    sorted_packages = {name: sorted(files) for name, files in packages.items()}
 
-    for package_name, sorted_files in sorted_packages.items():
+def build_package(
+    template: jinja2.Template,
+    output: str,
+    package_name: str,
+    sorted_files: list[Package],
+    precompress: bool = False,
+) -> list[str]:
+    # returns the paths that we wrote, relative to the output directory
+    paths = []
+
+    # /simple/{package}/index.html
+    path = os.path.join("simple", package_name, "index.html")
+    os.makedirs(os.path.join(output, os.path.dirname(path)), exist_ok=True)
+    with atomic_write(os.path.join(output, path), overwrite=True) as f:
+        # stream the page straight to disk so that huge packages never need
+        # to be held in memory as one big string
+        template.stream(
+            package_name=package_name,
+            files=sorted_files,
+        ).dump(f)
+    paths.append(path)
+
+    # /simple/{package}/index.json
+    path = os.path.join("simple", package_name, "index.json")
+    with atomic_write(os.path.join(output, path), overwrite=True) as f:
+        json.dump(get_simple_json(package_name, sorted_files), f)
+    paths.append(path)
+
+    # /pypi/{package}/json
+    path = os.path.join("pypi", package_name, "json")
+    os.makedirs(os.path.join(output, os.path.dirname(path)), exist_ok=True)
+    with atomic_write(os.path.join(output, path), overwrite=True) as f:
+        json.dump(get_package_json(sorted_files), f)
+    paths.append(path)
+
+    statistics.increment("files_written", len(paths))
+
+    if precompress:
+        paths.extend([path + suffix for path in paths for suffix in precompress_file(os.path.join(output, path))])
+    else:
+        for path in paths:
+            remove_compressed_copies(os.path.join(output, path))
+
+    return paths
+
+
+# the most search results that the sharded index will show at once
+SEARCH_RESULTS_LIMIT = 100
+
+
+def get_shard(package_name: str) -> str:
+    # package names always start with a letter or a number
+    first = package_name[0]
+    return first if first.isalpha() else "0-9"
+
+
+def build_sharded_index(
+    jinja_env: jinja2.Environment,
+    output: str,
+    title: str,
+    latest_versions: list[tuple[str, packaging.version.Version]],
+) -> list[str]:
+    # returns the paths that we wrote so that "build" can compress them
+    # split the list of packages up by the first letter of their name
+    shards: dict[str, list[tuple[str, packaging.version.Version]]] = collections.defaultdict(list)
+    for package, version in latest_versions:
+        shards[get_shard(package)].append((package, version))
+    shard_names = sorted(shards)
+
+    # /index/{shard}.html
+    shard_dir = os.path.join(output, "index")
+    os.makedirs(shard_dir, exist_ok=True)
+    template = jinja_env.get_template("index.html")
+    paths = []
+    for shard, packages in shards.items():
+        path = os.path.join(shard_dir, f"{shard}.html")
+        with atomic_write(path, overwrite=True) as f:
+            template.stream(
+                title=title,
+                packages=packages,
+                shards=shard_names,
+                root="../",
+            ).dump(f)
+        paths.append(path)
+
+    # get rid of shards that no longer have any packages in them, along with
+    # any compressed copies of them. shard names never contain a dot.
+    for filename in os.listdir(shard_dir):
+        name, _, ext = filename.partition(".")
+        if ext in ("html", "html.gz", "html.br") and name not in shards:
+            os.remove(os.path.join(shard_dir, filename))
+
+    # /search.json is as small as we can make it because every visitor to the
+    # front page is going to download it
+    path = os.path.join(output, "search.json")
+    with atomic_write(path, overwrite=True) as f:
+        json.dump([[package, str(version)] for package, version in latest_versions], f, separators=(",", ":"))
+    paths.append(path)
+
+    # /index.html
+    path = os.path.join(output, "index.html")
+    with atomic_write(path, overwrite=True) as f:
+        jinja_env.get_template("sharded.html").stream(
+            title=title,
+            shards=shard_names,
+            count=len(latest_versions),
+            limit=SEARCH_RESULTS_LIMIT,
+        ).dump(f)
+    paths.append(path)
+
+    return paths
+
+
+def build(
+    packages: Mapping[str, Iterable[Package]],
+    output: str,
+    title: str,
+    incremental: bool = False,
+    jobs: int = 1,
+    shard_index: bool = False,
+    precompress: bool = False,
+) -> None:
+    simple = os.path.join(output, "simple")
+
+    jinja_env = get_jinja_env()
+    package_template = jinja_env.get_template("package.html")
+
+    # packages are only looked at when they are written so that we never need
+    # to hold more than a few of them in memory, if they were not all in
+    # memory to start with. they are in order so that the indexes always come
+    # out the same no matter where the packages came from.
+    package_names = sorted(packages)
+
+    # in incremental mode we only write packages that changed since the last build
+    previous_manifest = load_manifest(output) if incremental else {}
+
+    def process(package_name: str) -> tuple[dict[str, Any], packaging.version.Version]:
+        # sorting package versions is actually pretty expensive, so we only do it once
+        files = packages[package_name]
+        with statistics.timer("sort"):
+            sorted_files = sort_packages(files)
+        latest_version = sorted_files[-1].version
+
+        # the digest is only used to find packages that have not changed and
+        # it is not free to make for a big package so only make it if we need it
+        digest = get_package_digest(package_name, sorted_files, precompress) if incremental else None
+
+        previous = previous_manifest.get(package_name)
+        if (
+            previous is not None
+            and previous.get("digest") == digest
+            and all(os.path.exists(os.path.join(output, path)) for path in previous.get("files") or [])
+        ):
+            logger.debug("skipping %s because it has not changed", package_name)
+            statistics.increment("packages_skipped")
+            return previous, latest_version
+
         logger.info("processing %s with %d files", package_name, len(sorted_files))
+        with statistics.timer("render"):
+            paths = build_package(package_template, output, package_name, sorted_files, precompress)
 
-        # /simple/{package}/index.html
-        simple_package_dir = os.path.join(simple, package_name)
-        os.makedirs(simple_package_dir, exist_ok=True)
-        with atomic_write(
-            os.path.join(simple_package_dir, "index.html"),
-            overwrite=True,
-        ) as f:
-            f.write(
-                jinja_env.get_template("package.html").render(
-                    package_name=package_name,
-                    files=sorted_files,
-                ),
-            )
+        # get rid of anything that we wrote last time but not this time
+        if previous is not None:
+            stale = [path for path in previous.get("files") or [] if path not in paths]
+            if stale:
+                remove_package(output, package_name, stale)
+
+        return {"digest": digest, "files": paths}, latest_version
 
-        # /pypi/{package}/json
-        pypi_package_dir = os.path.join(pypi, package_name)
-        os.makedirs(pypi_package_dir, exist_ok=True)
-        with atomic_write(os.path.join(pypi_package_dir, "json"), overwrite=True) as f:
-            json.dump(get_package_json(sorted_files), f)
+    # packages can be written at the same time because they never write to
+    # the same files. the indexes are written after every package is done so
+    # that they never point at a page that does not exist yet.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = dict(zip(package_names, executor.map(process, package_names)))
+    manifest = {package: entry for package, (entry, _) in results.items()}
 
     # /simple/index.html
     os.makedirs(simple, exist_ok=True)
-    with atomic_write(os.path.join(simple, "index.html"), overwrite=True) as f:
-        f.write(
-            jinja_env.get_template("simple.html").render(
-                package_names=sorted_packages,
-            ),
-        )
+    index_paths = [os.path.join(simple, "index.html")]
+    with atomic_write(index_paths[-1], overwrite=True) as f:
+        jinja_env.get_template("simple.html").stream(
+            package_names=package_names,
+        ).dump(f)
+
+    # /simple/index.json
+    index_paths.append(os.path.join(simple, "index.json"))
+    with atomic_write(index_paths[-1], overwrite=True) as f:
+        json.dump(get_simple_index_json(package_names), f)
+
+    latest_versions = sorted((package, latest_version) for package, (_, latest_version) in results.items())
+
+    if shard_index:
+        # /search.json, /index/{shard}.html, and /index.html
+        index_paths.extend(build_sharded_index(jinja_env, output, title, latest_versions))
+    else:
+        # /index.html
+        index_paths.append(os.path.join(output, "index.html"))
+        with atomic_write(index_paths[-1], overwrite=True) as f:
+            jinja_env.get_template("index.html").stream(
+                title=title,
+                packages=latest_versions,
+            ).dump(f)
+
+    for path in index_paths:
+        if precompress:
+            precompress_file(path)
+        else:
+            remove_compressed_copies(path)
 
-    # /index.html
-    with atomic_write(os.path.join(output, "index.html"), overwrite=True) as f:
-        f.write(
-            jinja_env.get_template("index.html").render(
-                packages=sorted(
-                    (
-                        package,
-                        sorted_versions[-1].version,
-                    )
-                    for package, sorted_versions in sorted_packages.items()
-                ),
-            ),
-        )
+    if incremental:
+        # only remove packages once the indexes no longer point at them
+        for package_name in previous_manifest.keys() - manifest.keys():
+            remove_package(output, package_name, previous_manifest[package_name].get("files") or [])
+
+        save_manifest(output, manifest)
 
 
 def create_package(artifact: Artifact) -> Package:
@@ -208,36 +1086,152 @@ def create_package(artifact: Artifact) -> Package:
         raise ValueError(f"unsafe package name: {artifact.filename}")
 
     # set values that the user did not provide
-    name, version = guess_name_version_from_filename(artifact.filename)
-    name = packaging.utils.canonicalize_name(name)
-
-    # parse the version to mutate it
-    parsed_version = packaging.version.parse(version or "0")
-
-    return Package(
-        filename=artifact.filename,
-        name=name,
-        version=parsed_version,
-        url=artifact.url,
-        sha256=artifact.sha256,
-        uploaded_at=artifact.uploaded_at,
-        uploaded_by=artifact.uploaded_by,
-    )
+    name, parsed_version = parse_filename(artifact.filename)
+
+    return Package.from_artifact(artifact, name, parsed_version)
+
+
+def iter_packages(artifacts: Iterable[Artifact]) -> Iterator[Package]:
+    # artifacts are usually still being fetched while we go through them so
+    # only the time spent in here is counted and it is added up at the end
+    elapsed = 0.0
+    try:
+        for artifact in artifacts:
+            start = time.perf_counter()
+            try:
+                package = create_package(artifact)
+            except ValueError as e:
+                logger.warning("%s (skipping package)", e)
+                continue
+            finally:
+                elapsed += time.perf_counter() - start
+            yield package
+    finally:
+        statistics.add_time("parse", elapsed)
 
 
-def create_packages(artifacts: Iterator[Artifact]) -> dict[str, set[Package]]:
+def create_packages(artifacts: Iterable[Artifact]) -> dict[str, set[Package]]:
     packages: dict[str, set[Package]] = collections.defaultdict(set)
-    for artifact in artifacts:
-        try:
-            package = create_package(artifact)
-        except ValueError as e:
-            logger.warning("%s (skipping package)", e)
-        else:
-            packages[package.name].add(package)
+    for package in iter_packages(artifacts):
+        packages[package.name].add(package)
 
     return packages
 
 
+class PackageSpool(MutableMapping[str, set[Package]]):
+    """Keeps packages on disk until they are built so that huge indexes do not have to fit in memory."""
+
+    def __init__(self: "PackageSpool", merge_duplicates: bool = False) -> None:
+        self.merge_duplicates = merge_duplicates
+
+        # an empty name gives us a database in a temporary file that goes
+        # away when it is closed. repositories are fetched and packages are
+        # built from many threads so they all share this and take turns.
+        self.connection = sqlite3.connect("", check_same_thread=False)
+        self.connection.execute(
+            """
+            CREATE TABLE packages (
+                name TEXT NOT NULL,
+                source INTEGER NOT NULL,
+                filename TEXT NOT NULL,
+                url TEXT NOT NULL,
+                sha256 TEXT,
+                uploaded_at TEXT NOT NULL,
+                uploaded_by TEXT,
+                metadata_sha256 TEXT
+            )
+            """,
+        )
+        self.connection.execute("CREATE INDEX packages_name ON packages (name, source)")
+        self.lock = threading.Lock()
+
+    def __enter__(self: "PackageSpool") -> "PackageSpool":
+        return self
+
+    def __exit__(self: "PackageSpool", *args: object) -> None:
+        self.close()
+
+    def close(self: "PackageSpool") -> None:
+        self.connection.close()
+
+    def add(self: "PackageSpool", source: int, packages: Iterable[Package]) -> int:
+        # the source is where the repository is in the list of repositories so
+        # that we can tell which one wins when we are not merging duplicates
+        rows = (
+            (
+                x.name,
+                source,
+                x.filename,
+                x.url,
+                x.sha256,
+                x.uploaded_at.isoformat(),
+                x.uploaded_by,
+                x.metadata_sha256,
+            )
+            for x in packages
+        )
+
+        # packages are written in batches so that other threads get a turn
+        count = 0
+        for batch in iter(lambda: list(itertools.islice(rows, 1000)), []):
+            with self.lock, self.connection:
+                self.connection.executemany("INSERT INTO packages VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch)
+            count += len(batch)
+
+        return count
+
+    def __getitem__(self: "PackageSpool", name: str) -> set[Package]:
+        with self.lock:
+            rows = self.connection.execute(
+                """
+                SELECT source, filename, url, sha256, uploaded_at, uploaded_by, metadata_sha256
+                FROM packages WHERE name = ? ORDER BY source
+                """,
+                (name,),
+            ).fetchall()
+
+        if not rows:
+            raise KeyError(name)
+
+        # the last repository in the list with this package wins
+        if not self.merge_duplicates:
+            rows = [row for row in rows if row[0] == rows[-1][0]]
+
+        return {
+            create_package(
+                Artifact(
+                    filename=row[1],
+                    url=row[2],
+                    sha256=row[3],
+                    uploaded_at=datetime.fromisoformat(row[4]),
+                    uploaded_by=row[5],
+                    metadata_sha256=row[6],
+                ),
+            )
+            for row in rows
+        }
+
+    def __setitem__(self: "PackageSpool", name: str, packages: set[Package]) -> None:
+        # these replace every other package with this name, from anywhere
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM packages WHERE name = ?", (name,))
+        self.add(0, (x for x in packages if x.name == name))
+
+    def __delitem__(self: "PackageSpool", name: str) -> None:
+        with self.lock, self.connection:
+            if self.connection.execute("DELETE FROM packages WHERE name = ?", (name,)).rowcount == 0:
+                raise KeyError(name)
+
+    def __iter__(self: "PackageSpool") -> Iterator[str]:
+        with self.lock:
+            names = [row[0] for row in self.connection.execute("SELECT DISTINCT name FROM packages ORDER BY name")]
+        return iter(names)
+
+    def __len__(self: "PackageSpool") -> int:
+        with self.lock:
+            return cast(int, self.connection.execute("SELECT COUNT(DISTINCT name) FROM packages").fetchone()[0])
+
+
 def load_repositories(path: str) -> Iterator[Repository]:
     with open(path, "rt", encoding="utf-8") as f:
         for line in f.read().splitlines():
@@ -281,6 +1275,194 @@ def get_github_token(token: Optional[str], token_stdin: bool) -> str:
     raise ValueError("No value for GITHUB_TOKEN.")
 
 
+class RateLimiter:
+    """Keeps track of how much of the GitHub API rate limit is left and waits for it to reset when it runs out."""
+
+    def __init__(self: "RateLimiter", reserve: int = 0) -> None:
+        # try to leave this many requests unused in case somebody else needs them
+        self.reserve = reserve
+
+        # for each resource (e.g. "core" or "graphql") we know how many
+        # requests are left and when that number resets
+        self.remaining: dict[str, tuple[int, int]] = {}
+
+        # for each resource and reset time we keep track of how many requests
+        # were left when we first saw it and the fewest that we have seen left
+        # so that we can report how much of the budget was used by this run
+        self.windows: dict[tuple[str, int], list[int]] = {}
+
+        # repositories may be fetched concurrently
+        self.lock = threading.Lock()
+
+    def update(self: "RateLimiter", resource: str, remaining: int, limit: int, reset: int, cost: int = 1) -> None:
+        with self.lock:
+            # what github tells us is the truth, even if it is more than we
+            # thought, because requests that we set aside may have cost
+            # nothing or never been made. a late response from a window that
+            # has already ended does no harm because we never wait for a
+            # reset that has already happened.
+            self.remaining[resource] = (remaining, reset)
+
+            # a window that we are seeing for the first time had as much left
+            # as there is now plus what the request that told us about it
+            # cost. it may have been started by somebody else with our token
+            # so it was not necessarily full.
+            window = self.windows.setdefault((resource, reset), [min(limit, remaining + cost), remaining])
+            window[1] = min(window[1], remaining)
+
+    def update_from_headers(self: "RateLimiter", headers: Mapping[str, str], cost: int = 1) -> None:
+        # not every response has rate limit headers
+        with contextlib.suppress(KeyError, ValueError):
+            self.update(
+                headers.get("x-ratelimit-resource", "core"),
+                int(float(headers["x-ratelimit-remaining"])),
+                int(float(headers["x-ratelimit-limit"])),
+                int(float(headers["x-ratelimit-reset"])),
+                cost,
+            )
+
+    def start(self: "RateLimiter", requester: github.Requester.Requester) -> None:
+        # this asks github where we are starting from. it goes through the
+        # same requester as everything else so that we get the limits for our
+        # token and not for our address. asking does not count against the
+        # rate limit.
+        try:
+            status, _, body = requester.requestJson("GET", "/rate_limit")
+            if status != 200:
+                raise ValueError(f"unexpected status {status}")
+            resources = json.loads(body)["resources"]
+        except (github.GithubException, requests.RequestException, ValueError, KeyError) as e:
+            logger.warning("unable to get the current rate limit: %s", e)
+            return
+
+        with self.lock:
+            for resource, data in resources.items():
+                key = (resource, int(data["reset"]))
+                self.remaining[resource] = (int(data["remaining"]), int(data["reset"]))
+                self.windows[key] = [int(data["remaining"]), int(data["remaining"])]
+
+    def wait(self: "RateLimiter", resource: str, cost: int = 1) -> None:
+        while True:
+            with self.lock:
+                remaining, reset = self.remaining.get(resource, (None, None))
+                if remaining is None or reset is None:
+                    return
+
+                delay = reset - time.time()
+                if remaining - cost >= self.reserve or delay <= 0:
+                    # set aside what we expect to use so that other jobs
+                    # don't think it is still available
+                    self.remaining[resource] = (remaining - cost, reset)
+                    return
+
+            # wait one extra second to make sure that the reset has happened
+            logger.warning("%s rate limit has been reached, waiting %d seconds for it to reset", resource, delay + 1)
+            statistics.increment("rate_limit_waits")
+            with statistics.timer("rate_limit_wait"):
+                time.sleep(delay + 1)
+
+            # we no longer know how much is left in this window
+            with self.lock:
+                if self.remaining.get(resource, (None, None))[1] == reset:
+                    del self.remaining[resource]
+
+    def left(self: "RateLimiter") -> dict[str, int]:
+        # the fewest requests that we saw left in the latest window for each resource
+        results: dict[str, tuple[int, int]] = {}
+        with self.lock:
+            for (resource, reset), (_, lowest) in self.windows.items():
+                if resource not in results or reset > results[resource][0]:
+                    results[resource] = (reset, lowest)
+        return {resource: lowest for resource, (_, lowest) in results.items()}
+
+    def used(self: "RateLimiter") -> dict[str, int]:
+        results: dict[str, int] = collections.defaultdict(int)
+        with self.lock:
+            for (resource, _), (start, lowest) in self.windows.items():
+                results[resource] += start - lowest
+        return dict(results)
+
+
+# pygithub waits this long between requests by default, which is about as fast
+# as github wants any one client to go
+REQUEST_INTERVAL = 0.25
+
+
+class Client:
+    """The GitHub client and HTTP session that every request in a run goes through."""
+
+    def __init__(
+        self: "Client",
+        token: str,
+        pool_size: int = 10,
+        retries: int = 3,
+        backoff: float = 0.5,
+        download_jobs: int = 4,
+        request_interval: float = REQUEST_INTERVAL,
+        base_url: str = github.Consts.DEFAULT_BASE_URL,
+    ) -> None:
+        self.token = token
+
+        # this limits how many files get downloaded at once across every
+        # repository that is being fetched
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=download_jobs)
+
+        # lazy means that we do not spend a request on fetching a repository
+        # before we ask it for its releases. every job shares this client and
+        # pygithub spaces out the requests from all of them, not from each.
+        self.github = github.Github(
+            auth=github.Auth.Token(token),
+            base_url=base_url,
+            lazy=True,
+            pool_size=pool_size,
+            retry=github.GithubRetry(total=retries, backoff_factor=backoff),
+            seconds_between_requests=request_interval or None,
+        )
+
+        # everything else, like downloading assets or talking to graphql, goes
+        # through this session so that connections are kept alive and reused.
+        # all of our requests are reads so it is safe to retry any of them.
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=urllib3.util.Retry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=None,
+            ),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # every request to the api tells this how much of the rate limit is left
+        self.limiter = RateLimiter()
+        self.session.hooks["response"].append(self.on_response)
+
+    @property
+    def graphql_url(self: "Client") -> str:
+        # graphql is next to the rest api on github.com but on github
+        # enterprise server the rest api is at /api/v3 and graphql is at
+        # /api/graphql
+        base_url = self.github.requester.base_url.rstrip("/")
+        return f"{base_url.removesuffix('/v3')}/graphql"
+
+    def on_response(self: "Client", response: requests.Response, *args: Any, **kwargs: Any) -> None:
+        statistics.increment("http_requests")
+
+    def close(self: "Client") -> None:
+        self.executor.shutdown(cancel_futures=True)
+        self.github.close()
+        self.session.close()
+
+    def __enter__(self: "Client") -> "Client":
+        return self
+
+    def __exit__(self: "Client", *args: object) -> None:
+        self.close()
+
+
 # this fetches release artifacts for a given repository
 # release artifacts just say "this is a release and it has these files"
 # it is an array that has elements like this:
@@ -317,84 +1499,976 @@ def get_github_token(token: Optional[str], token_stdin: bool) -> str:
 #                   'user_view_type': 'public'},
 #      'url': 'https://api.github.com/repos/plockaby/test-python/releases/assets/249839047'}
 #
-def get_artifacts(token: str, repository: Repository) -> Iterator[Artifact]:
+# github lets us ask for this many releases at a time
+RELEASES_PER_PAGE = 100
+
+
+class Releases(NamedTuple):
+    # the assets that are attached to each release. from the rest api these
+    # are listed a page at a time as they are needed so that a repository
+    # with a lot of releases is never held all at once, which means that
+    # they can only be gone through once.
+    assets: Iterable[list[dict]]
+
+    # if the releases have not changed since the last time that we looked
+    # then these are the artifacts that we found the last time
+    artifacts: Optional[list[Artifact]] = None
+
+    # this gets saved so that we can ask if the releases have changed next time
+    etag: Optional[str] = None
+
+
+@statistics.timer("list_releases")
+def get_releases_page(
+    client: Client,
+    url: str,
+    parameters: Optional[dict[str, Any]] = None,
+    headers: Optional[dict[str, str]] = None,
+) -> tuple[int, dict[str, Any], Any, Optional[str]]:
+    # this returns the status, headers, and body of one page of releases and
+    # the url for the next page, if there is one
+    status, response_headers, body = client.github.requester.requestJson(
+        "GET",
+        url,
+        parameters=parameters,
+        headers=headers,
+    )
+    client.limiter.update_from_headers(response_headers, 0 if status == 304 else 1)
+    data: Any = json.loads(body) if body else {}
+
+    # the link to the next page already has all of the parameters in it
+    links = requests.utils.parse_header_links(response_headers.get("link") or "")
+    return status, response_headers, data, next((x["url"] for x in links if x.get("rel") == "next"), None)
+
+
+def iter_release_assets(client: Client, data: Any, url: Optional[str]) -> Iterator[list[dict]]:
+    # the first page has already been fetched and the rest are fetched when
+    # we get to them
+    while True:
+        yield from (release.get("assets") or [] for release in data)
+        if url is None:
+            return
+
+        status, headers, data, url = get_releases_page(client, url)
+        if status != 200:
+            raise client.github.requester.createException(status, headers, data)
+
+
+def get_releases(client: Client, repository: Repository, cache: Optional[Cache] = None) -> Releases:
     logger.info(
         "fetching release artifacts for %s/%s",
         repository.owner,
         repository.name,
     )
 
-    gh = github.Github(auth=github.Auth.Token(token))
-    gh_repo = gh.get_repo(f"{repository.owner}/{repository.name}")
-    releases = gh_repo.get_releases()
+    # don't start unless we have enough of the rate limit left to finish
+    client.limiter.wait("core", get_expected_cost(repository, cache))
+
+    # if we are keeping a cache then ask github if the list of releases has
+    # changed since we last looked. responses that are "304 Not Modified" do
+    # not count against the rate limit. this only looks at the first page of
+    # releases, which is where new releases show up, and the etag changes when
+    # anything about those releases changes, including their download counts.
+    cached = cache.get_releases(repository) if cache is not None and cache.path is not None else None
+
+    # we list the releases ourselves because every release that pygithub
+    # gives us costs another request when we look at its assets
+    status, headers, data, url = get_releases_page(
+        client,
+        f"{client.github.requester.base_url}/repos/{repository.owner}/{repository.name}/releases",
+        {"per_page": RELEASES_PER_PAGE},
+        {"If-None-Match": cached[0]} if cached is not None else None,
+    )
+    if status == 304 and cached is not None:
+        logger.info("releases for %s/%s have not changed", repository.owner, repository.name)
+        statistics.increment("releases_not_modified")
+        return Releases(assets=[], artifacts=cached[1])
+
+    if status != 200:
+        raise client.github.requester.createException(status, headers, data)
+
+    # the etag for the first page is the one that we ask about next time
+    return Releases(
+        assets=iter_release_assets(client, data, url),
+        etag=headers.get("etag") if cache is not None and cache.path is not None else None,
+    )
+
 
-    for release in releases:
-        assets = release.raw_data.get("assets") or []
-        yield from create_artifacts(assets)
+def get_expected_cost(repository: Repository, cache: Optional[Cache] = None) -> int:
+    # how many requests we think that listing the releases for a repository
+    # will need, based on how many releases it had the last time we looked
+    count = cache.get_release_count(repository) if cache is not None else None
+    if count is None:
+        return 1
 
+    # one for each page. asking about the first page is how we find out if
+    # anything changed and it costs nothing if nothing did.
+    return max(1, -(-count // RELEASES_PER_PAGE))
 
-def create_artifacts(assets: list[dict]) -> Iterator[Artifact]:
-    if len(assets) == 0:
+
+def order_repositories(repositories: list[Repository], cache: Optional[Cache] = None) -> list[Repository]:
+    # do the cheapest repositories first so that as many repositories as
+    # possible are finished before we have to wait for the rate limit
+    return sorted(repositories, key=lambda x: get_expected_cost(x, cache))
+
+
+def get_artifacts(client: Client, repository: Repository, cache: Optional[Cache] = None) -> Iterator[Artifact]:
+    releases = get_releases(client, repository, cache)
+    if releases.artifacts is not None:
+        yield from releases.artifacts
         return
 
-    # keep track of all the assets that we've found
-    results = []
+    # the cache needs every artifact from the repository but there is no
+    # reason to hold on to them if there is nowhere to save them
+    saving = cache is not None and releases.etag is not None
+    artifacts: list[Artifact] = []
+    digests: list[str] = []
+    count = 0
+    for assets in releases.assets:
+        if saving:
+            count += 1
+            digests.extend(Cache.get_digest_key(x) for x in assets)
+
+        for artifact in create_artifacts(assets, cache, client.session, client.executor):
+            if saving:
+                artifacts.append(artifact)
+            yield artifact
+
+    if cache is not None and releases.etag is not None:
+        cache.set_releases(repository, releases.etag, artifacts, digests, count)
+
+
+# the graphql api lets us ask about many repositories in a single request
+GRAPHQL_BATCH_SIZE = 25
+
+# these are the fields that we need from each release asset
+GRAPHQL_ASSET_FIELDS = """
+    pageInfo { hasNextPage endCursor }
+    nodes { databaseId name downloadUrl size updatedAt digest uploadedBy { login } }
+"""
+
+
+def get_graphql_asset(node: dict) -> dict:
+    # make graphql release assets look like the rest api release assets so
+    # that they can go through "create_artifacts" just like everything else
+    return {
+        "id": node["databaseId"],
+        "name": node["name"],
+        "browser_download_url": node["downloadUrl"],
+        "size": node["size"],
+        "updated_at": node["updatedAt"],
+        "digest": node.get("digest"),
+        "uploader": {"login": (node.get("uploadedBy") or {}).get("login")},
+    }
+
+
+def query_graphql(client: Client, url: str, query: str, variables: dict[str, Any], cost: int = 1) -> dict[str, Any]:
+    client.limiter.wait("graphql", cost)
+    response = client.session.post(
+        url,
+        json={"query": query, "variables": variables},
+        headers={"Authorization": f"bearer {client.token}"},
+        timeout=30,
+    )
+    client.limiter.update_from_headers(response.headers, cost)
+    response.raise_for_status()  # we only expect 200 responses
+
+    data = response.json()
+    if data.get("errors"):
+        raise ValueError(f"graphql query failed: {'; '.join(x.get('message', '') for x in data['errors'])}")
+
+    return cast(dict[str, Any], data["data"])
+
+
+@statistics.timer("list_releases")
+def get_releases_graphql(
+    client: Client,
+    repositories: list[Repository],
+    batch_size: int = GRAPHQL_BATCH_SIZE,
+) -> dict[Repository, list[list[dict]]]:
+    # this returns the assets for every release for every repository, and it
+    # does it by asking for many repositories at once and only going back for
+    # more pages from repositories or releases that have them
+    releases: dict[Repository, list[list[dict]]] = {repository: [] for repository in repositories}
+
+    # each piece of work is either a page of releases for a repository or a
+    # page of assets for a release that has more assets than fit on one page
+    work: list[tuple[Any, ...]] = [("releases", repository, None) for repository in releases]
+
+    while work:
+        batch, work = work[:batch_size], work[batch_size:]
+        logger.info("querying %d repositories and releases through graphql", len(batch))
+
+        parameters = []
+        selections = []
+        variables: dict[str, Any] = {}
+        for i, item in enumerate(batch):
+            if item[0] == "releases":
+                _, repository, cursor = item
+                parameters.append(f"$owner{i}: String!, $name{i}: String!, $cursor{i}: String")
+                variables.update({f"owner{i}": repository.owner, f"name{i}": repository.name, f"cursor{i}": cursor})
+                selections.append(
+                    f"""
+                    q{i}: repository(owner: $owner{i}, name: $name{i}) {{
+                        releases(first: 100, after: $cursor{i}, orderBy: {{field: CREATED_AT, direction: DESC}}) {{
+                            pageInfo {{ hasNextPage endCursor }}
+                            nodes {{ id releaseAssets(first: 100) {{ {GRAPHQL_ASSET_FIELDS} }} }}
+                        }}
+                    }}
+                    """,
+                )
+            else:
+                _, _, node_id, cursor = item
+                parameters.append(f"$id{i}: ID!, $cursor{i}: String")
+                variables.update({f"id{i}": node_id, f"cursor{i}": cursor})
+                selections.append(
+                    f"""
+                    q{i}: node(id: $id{i}) {{
+                        ... on Release {{ releaseAssets(first: 100, after: $cursor{i}) {{ {GRAPHQL_ASSET_FIELDS} }} }}
+                    }}
+                    """,
+                )
+
+        query = f"query({', '.join(parameters)}) {{ {' '.join(selections)} }}"
+        # every connection that asks for 100 things costs about one point
+        data = query_graphql(client, client.graphql_url, query, variables, cost=len(batch) + 1)
+
+        for i, item in enumerate(batch):
+            node = data.get(f"q{i}")
+
+            if item[0] == "releases":
+                repository = item[1]
+                if node is None:
+                    raise ValueError(f"invalid repository: {repository.owner}/{repository.name}")
+
+                for release in node["releases"]["nodes"]:
+                    assets = [get_graphql_asset(x) for x in release["releaseAssets"]["nodes"]]
+                    releases[repository].append(assets)
+
+                    page = release["releaseAssets"]["pageInfo"]
+                    if page["hasNextPage"]:
+                        work.append(("assets", assets, release["id"], page["endCursor"]))
+
+                page = node["releases"]["pageInfo"]
+                if page["hasNextPage"]:
+                    work.append(("releases", repository, page["endCursor"]))
+            else:
+                assets = item[1]
+                if node is None:
+                    raise ValueError(f"invalid release: {item[2]}")
+
+                assets.extend(get_graphql_asset(x) for x in node["releaseAssets"]["nodes"])
+
+                page = node["releaseAssets"]["pageInfo"]
+                if page["hasNextPage"]:
+                    work.append(("assets", assets, item[2], page["endCursor"]))
+
+    return releases
+
 
-    # keep track of any sha256 sums that we find
-    sha256sums = {}
+@statistics.timer("download_sha256sums")
+def get_sha256sums(session: requests.Session, url: str) -> dict[str, str]:
+    response = session.get(url, timeout=10)
+    response.raise_for_status()  # we only expect 200 responses
+
+    # set the encoding to ascii so that we don't make the system guess
+    response.encoding = "ascii"
+
+    # split the lines, then split each line
+    return {x[1]: x[0] for x in [line.strip().split() for line in response.text.split("\n") if len(line.strip())]}
+
+
+# big chunks mean fewer trips through the python interpreter per megabyte
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+@statistics.timer("download_digests")
+def get_sha256(session: requests.Session, url: str, cache: Optional[Cache] = None) -> str:
+    response = session.get(url, stream=True, timeout=30)
+    response.raise_for_status()  # we only expect 200 responses
+
+    # wheels have their core metadata inside of them and since we are
+    # downloading the whole thing anyway we might as well pull it out. zip
+    # files have to be read from the end so we keep a copy on disk.
+    filename = os.path.basename(urllib.parse.unquote(urllib.parse.urlsplit(url).path))
+    spool: Optional[IO[bytes]] = None
+    if cache is not None and cache.wants_metadata() and filename.endswith(".whl"):
+        spool = tempfile.TemporaryFile()
+
+    try:
+        # expecting a binary response
+        hasher = hashlib.sha256()
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            if chunk:  # filter out keep-alive new chunks
+                hasher.update(chunk)
+                statistics.increment("download_bytes", len(chunk))
+                if spool is not None:
+                    spool.write(chunk)
+
+        sha256 = hasher.hexdigest()
+        if spool is not None and cache is not None:
+            try:
+                cache.set_metadata(sha256, get_wheel_metadata(spool, filename))
+            except (zipfile.BadZipFile, ValueError) as e:
+                logger.warning("unable to read metadata from %s: %s", filename, e)
+    finally:
+        if spool is not None:
+            spool.close()
+
+    return sha256
+
+
+def get_wheel_metadata(f: IO[bytes], filename: str) -> bytes:
+    # https://packaging.python.org/en/latest/specifications/binary-distribution-format/
+    with zipfile.ZipFile(f) as zf:
+        names = [x for x in zf.namelist() if re.match(r"[^/]+\.dist-info/METADATA$", x)]
+
+        # there should only be one but if there are more then we want the
+        # one that matches the name and version of the wheel
+        if len(names) > 1:
+            prefix = "-".join(filename.split("-")[:2]) + ".dist-info/"
+            names = [x for x in names if x.lower() == (prefix + "METADATA").lower()]
+
+        if len(names) != 1:
+            raise ValueError(f"unable to find core metadata in {filename}")
+
+        return zf.read(names[0])
+
+
+# zip files keep their table of contents at the end, which is usually small
+# enough that this gets all of it in one request, along with any small files
+# that happen to be at the end like METADATA usually is
+RANGE_REQUEST_SIZE = 64 * 1024
+
+
+class RangeFile(io.RawIOBase):
+    """A read-only file over HTTP that only fetches the parts that get read."""
+
+    def __init__(self: "RangeFile", session: requests.Session, url: str, size: int, tail: bytes) -> None:
+        self.session = session
+        self.url = url
+        self.size = size
+        self.position = 0
+
+        # whatever we fetched last, keyed by where it starts, plus the end of
+        # the file because zipfile keeps going back to it
+        self.blocks = {size - len(tail): tail}
+        self.last: Optional[tuple[int, bytes]] = None
+
+    def readable(self: "RangeFile") -> bool:
+        return True
+
+    def seekable(self: "RangeFile") -> bool:
+        return True
+
+    def tell(self: "RangeFile") -> int:
+        return self.position
+
+    def seek(self: "RangeFile", offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f"invalid whence: {whence}")
+        return self.position
+
+    def read(self: "RangeFile", size: int = -1) -> bytes:
+        if size < 0 or self.position + size > self.size:
+            size = self.size - self.position
+        if size <= 0:
+            return b""
+
+        data = self.get_block(self.position, size)
+        self.position += len(data)
+        return data
+
+    def readinto(self: "RangeFile", buffer: Any) -> int:
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def get_block(self: "RangeFile", start: int, size: int) -> bytes:
+        blocks = list(self.blocks.items())
+        if self.last is not None:
+            blocks.append(self.last)
+
+        for offset, block in blocks:
+            begin, stop = start - offset, start - offset + size
+            if 0 <= begin and stop <= len(block):
+                return block[begin:stop]
+
+        # read ahead because zipfile reads in lots of little pieces
+        end = min(self.size, start + max(size, RANGE_REQUEST_SIZE))
+        response = self.session.get(self.url, headers={"Range": f"bytes={start}-{end - 1}"}, timeout=30)
+        response.raise_for_status()
+        if response.status_code != 206 or len(response.content) != end - start:
+            raise ValueError(f"server did not honor range request for {self.url}")
+
+        statistics.increment("metadata_range_requests")
+        statistics.increment("metadata_range_bytes", len(response.content))
+        self.last = (start, response.content)
+        return response.content[:size]
+
+
+@statistics.timer("download_metadata")
+def get_remote_wheel_metadata(session: requests.Session, url: str) -> bytes:
+    # https://peps.python.org/pep-0658/ metadata without downloading the
+    # whole wheel by only asking for the parts of the zip file that we need.
+    # first ask for the end of the file, which also tells us how big it is.
+    filename = os.path.basename(urllib.parse.unquote(urllib.parse.urlsplit(url).path))
+    response = session.get(url, headers={"Range": f"bytes=-{RANGE_REQUEST_SIZE}"}, stream=True, timeout=30)
+
+    with response:
+        response.raise_for_status()
+
+        if response.status_code == 206:
+            match = re.match(r"bytes \d+-\d+/(\d+)$", response.headers.get("Content-Range", ""))
+            if match is None:
+                raise ValueError(f"server sent a range that we do not understand for {url}")
+
+            tail = response.content
+            statistics.increment("metadata_range_requests")
+            statistics.increment("metadata_range_bytes", len(tail))
+
+            # github redirects downloads somewhere else so we go straight
+            # there for the rest of the file instead of being redirected again
+            size = int(match.group(1))
+            return get_wheel_metadata(cast(IO[bytes], RangeFile(session, response.url, size, tail)), filename)
+
+        if response.status_code != 200:
+            raise ValueError(f"unexpected response {response.status_code} for {url}")
+
+        # the server ignored us and is sending the whole thing
+        logger.debug("server does not support range requests for %s", url)
+        statistics.increment("metadata_full_downloads")
+        with tempfile.TemporaryFile() as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                statistics.increment("download_bytes", len(chunk))
+            return get_wheel_metadata(f, filename)
+
+
+def get_asset_digest(asset: dict) -> Optional[str]:
+    # github calculates digests for uploaded assets and gives them to us as
+    # something like "sha256:abcdef..." but older assets may not have one
+    digest = asset.get("digest")
+    if not digest:
+        return None
+
+    algorithm, _, value = digest.partition(":")
+    if algorithm != "sha256" or not re.match(r"[a-f\d]{64}$", value):
+        logger.debug("ignoring unsupported digest for %s: %s", asset["name"], digest)
+        return None
+
+    return value
+
+
+class ReleaseFiles(NamedTuple):
+    # where to find any pre-existing checksums
+    sha256sums_url: Optional[str]
+
+    # every asset that we are interested in and the artifact that it will become
+    results: list[tuple[dict, dict[str, Any]]]
+
+    # core metadata files that were published next to wheels, by wheel name
+    metadata: dict[str, dict]
+
+
+def get_release_files(assets: list[dict]) -> ReleaseFiles:
+    sha256sums_url = None
+    results = []
+    metadata = {}
 
     for asset in assets:
         name = asset["name"]
         url = asset["browser_download_url"]
 
+        # https://peps.python.org/pep-0658/ says that the core metadata for a
+        # wheel lives next to it with ".metadata" on the end
+        if name.endswith(".whl.metadata"):
+            metadata[name[: -len(".metadata")]] = asset
+            continue
+
         # we only want wheels and tar.gz and maybe pre-existing checksums
         if not (name.endswith(".whl") or name.endswith(".gz") or name.endswith(".bz2") or name == "sha256sum.txt"):
             continue
 
         if name == "sha256sum.txt":
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()  # we only expect 200 responses
+            sha256sums_url = url
+        else:
+            results.append(
+                (
+                    asset,
+                    {
+                        "filename": name,
+                        "url": url,
+                        "sha256": None,
+                        "uploaded_at": datetime.fromisoformat(
+                            asset["updated_at"].rstrip("Z"),
+                        ),
+                        "uploaded_by": asset["uploader"]["login"],
+                        "metadata_sha256": None,
+                    },
+                ),
+            )
 
-            # set the encoding to ascii so that we don't make the system guess
-            response.encoding = "ascii"
+    # metadata files for wheels that are not there are no use to anybody
+    names = {result["filename"] for _, result in results}
+    return ReleaseFiles(sha256sums_url, results, {k: v for k, v in metadata.items() if k in names})
 
-            # split the lines, then split each line
-            sha256sums = {
-                x[1]: x[0] for x in [line.strip().split() for line in response.text.split("\n") if len(line.strip())]
-            }
 
+def get_known_digest(asset: dict, cache: Cache) -> tuple[Optional[str], str]:
+    # prefer the digest that github gives us and then our own cache
+    sha256 = get_asset_digest(asset)
+    if sha256 is not None:
+        return sha256, "github"
+
+    return cache.get_digest(asset), "cache"
+
+
+def set_result_digest(asset: dict, result: dict[str, Any], sha256: str, source: str, cache: Cache) -> None:
+    logger.debug("found digest for %s from %s", result["filename"], source)
+    statistics.increment(f"digests_from_{source}")
+    if source != "download":
+        statistics.increment("download_bytes_avoided", asset.get("size") or 0)
+
+    cache.set_digest(asset, sha256)
+    result["sha256"] = sha256
+
+
+def set_result_metadata_digest(asset: dict, result: dict[str, Any], sha256: str, source: str, cache: Cache) -> None:
+    logger.debug("found metadata digest for %s from %s", result["filename"], source)
+    statistics.increment("metadata_files")
+
+    cache.set_digest(asset, sha256)
+    result["metadata_sha256"] = sha256
+
+
+def create_artifacts(
+    assets: list[dict],
+    cache: Optional[Cache] = None,
+    session: Optional[requests.Session] = None,
+    executor: Optional[concurrent.futures.Executor] = None,
+) -> Iterator[Artifact]:
+    if len(assets) == 0:
+        return
+
+    # without a persistent cache we still use an in-memory one
+    if cache is None:
+        cache = Cache()
+
+    if session is None:
+        session = requests.Session()
+
+    # keep track of any sha256 sums that we find but only fetch them if we
+    # find a file that we don't already have a digest for
+    sha256sums_url, results, metadata = get_release_files(assets)
+    sha256sums: Optional[dict[str, str]] = None
+
+    # files that need to be downloaded are downloaded in the background, if
+    # we were given somewhere to do that, while we look at everything else
+    downloads: dict[int, concurrent.futures.Future[str]] = {}
+
+    for index, (asset, result) in enumerate(results):
+        sha256, source = get_known_digest(asset, cache)
+
+        # then look at any checksums that were published with the release
+        if sha256 is None and sha256sums_url is not None:
+            if sha256sums is None:
+                sha256sums = get_sha256sums(session, sha256sums_url)
+            sha256, source = sha256sums.get(result["filename"]), "sha256sums"
+
+        if sha256 is None:
+            if executor is not None:
+                downloads[index] = executor.submit(get_sha256, session, result["url"], cache)
+            continue
+
+        set_result_digest(asset, result, sha256, source, cache)
+
+    # metadata files are small enough that we just download them if we need to
+    for _, result in results:
+        metadata_asset = metadata.get(result["filename"])
+        if metadata_asset is None:
+            continue
+
+        sha256, source = get_known_digest(metadata_asset, cache)
+        if sha256 is None and sha256sums_url is not None:
+            if sha256sums is None:
+                sha256sums = get_sha256sums(session, sha256sums_url)
+            sha256, source = sha256sums.get(metadata_asset["name"]), "sha256sums"
+        if sha256 is None:
+            sha256, source = get_sha256(session, metadata_asset["browser_download_url"]), "download"
+
+        set_result_metadata_digest(metadata_asset, result, sha256, source, cache)
+
+    try:
+        # everything comes out in the same order that it went in
+        for index, (asset, result) in enumerate(results):
+            if result["sha256"] is None:
+                # for any file that doesn't have a sha256 hash, download the file and calculate it
+                future = downloads.get(index)
+                sha256 = future.result() if future is not None else get_sha256(session, result["url"], cache)
+                set_result_digest(asset, result, sha256, "download", cache)
+
+            yield Artifact(**result)
+    finally:
+        # don't keep downloading things that nobody is going to look at
+        for future in downloads.values():
+            future.cancel()
+
+
+def fetch_packages(client: Client, repository: Repository, cache: Optional[Cache] = None) -> dict[str, set[Package]]:
+    # this creates a dictionary of sets
+    # the key is the name of the package
+    # the value is a set of packages
+    return create_packages(get_artifacts(client, repository, cache))
+
+
+def create_packages_from_releases(
+    releases: list[list[dict]],
+    cache: Optional[Cache] = None,
+    session: Optional[requests.Session] = None,
+    executor: Optional[concurrent.futures.Executor] = None,
+) -> dict[str, set[Package]]:
+    # this is like "fetch_packages" for release assets that were already fetched
+    return create_packages(
+        itertools.chain.from_iterable(create_artifacts(assets, cache, session, executor) for assets in releases),
+    )
+
+
+def merge_packages(
+    packages: dict[str, set[Package]],
+    data: dict[str, set[Package]],
+    merge_duplicates: bool,
+) -> None:
+    for key, value in data.items():
+        logger.info("found %d files for package %s", len(value), key)
+        if merge_duplicates:
+            # if this key is already in the dict then merge the packages
+            packages[key] = packages.get(key, set()) | value
         else:
-            results.append(
-                {
-                    "filename": name,
-                    "url": url,
-                    "sha256": None,
-                    "uploaded_at": datetime.fromisoformat(
-                        asset["updated_at"].rstrip("Z"),
-                    ),
-                    "uploaded_by": asset["uploader"]["login"],
-                },
+            # if this key is already in the dict then replace it
+            packages[key] = value
+
+
+def get_packages(
+    client: Client,
+    repositories: list[Repository],
+    cache: Cache,
+    backend: str,
+    jobs: int,
+    merge_duplicates: bool,
+    spool: Optional[PackageSpool] = None,
+) -> dict[str, set[Package]]:
+    packages: dict[str, set[Package]] = {}
+
+    if backend == "graphql":
+        # list everything up front in as few requests as possible
+        releases = get_releases_graphql(client, repositories)
+
+        # each repository lets go of its release assets once it has them so
+        # that they are not all kept until every repository is done
+        def get_repository_artifacts(repository: Repository) -> Iterator[Artifact]:
+            assets = releases.pop(repository)
+            return itertools.chain.from_iterable(
+                create_artifacts(x, cache, client.session, client.executor) for x in assets
+            )
+
+        def fetch(repository: Repository) -> dict[str, set[Package]]:
+            return create_packages_from_releases(releases.pop(repository), cache, client.session, client.executor)
+
+    else:
+
+        def get_repository_artifacts(repository: Repository) -> Iterator[Artifact]:
+            return get_artifacts(client, repository, cache)
+
+        def fetch(repository: Repository) -> dict[str, set[Package]]:
+            return fetch_packages(client, repository, cache)
+
+    # when spooling, packages go to disk as soon as they are found instead of
+    # being collected here, along with where their repository is in the list
+    sources = {repository: index for index, repository in enumerate(repositories)}
+
+    def fetch_and_record(repository: Repository) -> dict[str, set[Package]]:
+        # keep track of how long every repository takes and how big it is
+        start = time.perf_counter()
+        if spool is not None:
+            files = spool.add(sources[repository], iter_packages(get_repository_artifacts(repository)))
+            result = {}
+        else:
+            result = fetch(repository)
+            files = sum(len(x) for x in result.values())
+        statistics.add_repository(repository, time.perf_counter() - start, files)
+        return result
+
+    # repositories are fetched concurrently, cheapest first, but the results
+    # are merged in the same order as the list of repositories so that
+    # merging is deterministic and the last repository in the list still
+    # wins when not merging.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            repository: executor.submit(fetch_and_record, repository)
+            for repository in order_repositories(repositories, cache)
+        }
+        for repository in repositories:
+            merge_packages(packages, futures[repository].result(), merge_duplicates)
+
+    return packages
+
+
+class AsyncFetcher:
+    """Fetches packages from many repositories at once using asyncio."""
+
+    def __init__(self: "AsyncFetcher", client: Client, cache: Cache, limit: int, host_limit: int) -> None:
+        self.client = client
+        self.cache = cache
+
+        # this limits how many requests are in flight in total and to each host
+        self.limit = asyncio.Semaphore(limit)
+        self.host_limit = host_limit
+        self.host_limits: dict[str, asyncio.Semaphore] = {}
+
+        # this limits how many repositories are worked on at once when they
+        # are being spooled to disk
+        self.repository_limit = asyncio.Semaphore(limit)
+
+    async def call(self: "AsyncFetcher", url: str, function: Callable[..., T], *args: Any) -> T:
+        # our http clients are not asynchronous so every request runs in a
+        # thread but we decide when it gets to run. we wait for the host
+        # before waiting for everything so that a busy host does not hold on
+        # to a slot that some other host could have used.
+        host = urllib.parse.urlsplit(url).hostname or ""
+        host_limit = self.host_limits.setdefault(host, asyncio.Semaphore(self.host_limit))
+        async with host_limit, self.limit:
+            return await asyncio.to_thread(function, *args)
+
+    async def create_artifacts(self: "AsyncFetcher", assets: list[dict]) -> list[Artifact]:
+        # this works just like "create_artifacts" except that everything that
+        # needs to be fetched for a release is fetched at the same time
+        sha256sums_url, results, metadata = get_release_files(assets)
+
+        # metadata files go through the same steps as everything else but
+        # their digests end up on the artifact for their wheel
+        files: list[tuple[dict, dict[str, Any], Callable[..., None]]] = [
+            (asset, result, set_result_digest) for asset, result in results
+        ]
+        files.extend(
+            (metadata[result["filename"]], result, set_result_metadata_digest)
+            for _, result in results
+            if result["filename"] in metadata
+        )
+
+        pending = []
+        for asset, result, set_digest in files:
+            sha256, source = get_known_digest(asset, self.cache)
+            if sha256 is None:
+                pending.append((asset, result, set_digest))
+            else:
+                set_digest(asset, result, sha256, source, self.cache)
+
+        if pending and sha256sums_url is not None:
+            sha256sums = await self.call(sha256sums_url, get_sha256sums, self.client.session, sha256sums_url)
+            for asset, result, set_digest in pending:
+                sha256 = sha256sums.get(asset["name"])
+                if sha256 is not None:
+                    set_digest(asset, result, sha256, "sha256sums", self.cache)
+            pending = [x for x in pending if x[0]["name"] not in sha256sums]
+
+        urls = [asset["browser_download_url"] for asset, _, _ in pending]
+        digests = await asyncio.gather(
+            *(self.call(url, get_sha256, self.client.session, url, self.cache) for url in urls),
+        )
+        for (asset, result, set_digest), sha256 in zip(pending, digests):
+            set_digest(asset, result, sha256, "download", self.cache)
+
+        return [Artifact(**result) for _, result in results]
+
+    async def fetch(
+        self: "AsyncFetcher",
+        repository: Repository,
+        assets: Optional[list[list[dict]]] = None,
+    ) -> dict[str, set[Package]]:
+        # releases are listed here unless somebody already listed them for us
+        if assets is None:
+            releases = await self.call(
+                self.client.github.requester.base_url,
+                get_releases,
+                self.client,
+                repository,
+                self.cache,
             )
+            if releases.artifacts is not None:
+                return create_packages(iter(releases.artifacts))
 
-    for result in results:
-        if result["filename"] in sha256sums:
-            # found the hash, just add it to the file
-            if result["filename"] in sha256sums:
-                result["sha256"] = sha256sums[result["filename"]]
+            # every release is worked on at once so we need all of them
+            assets = await asyncio.to_thread(list, releases.assets)
         else:
-            # for any file that doesn't have a sha256 hash, download the file and calculate it
-            response = requests.get(result["url"], stream=True, timeout=30)
-            response.raise_for_status()  # we only expect 200 responses
+            releases = Releases(assets=assets)
+
+        results = await asyncio.gather(*(self.create_artifacts(x) for x in assets))
+        artifacts = list(itertools.chain.from_iterable(results))
+        if self.cache is not None and releases.etag is not None:
+            digests = [Cache.get_digest_key(asset) for x in assets for asset in x]
+            self.cache.set_releases(repository, releases.etag, artifacts, digests, len(assets))
+        return create_packages(iter(artifacts))
+
+    async def fetch_and_record(
+        self: "AsyncFetcher",
+        repository: Repository,
+        assets: Optional[list[list[dict]]] = None,
+    ) -> dict[str, set[Package]]:
+        # keep track of how long every repository takes and how big it is
+        start = time.perf_counter()
+        packages = await self.fetch(repository, assets)
+        statistics.add_repository(repository, time.perf_counter() - start, sum(len(x) for x in packages.values()))
+        return packages
+
+    async def fetch_and_spool(
+        self: "AsyncFetcher",
+        repository: Repository,
+        assets: Optional[list[list[dict]]],
+        spool: PackageSpool,
+        source: int,
+    ) -> None:
+        # only this many repositories are worked on at once and each one goes
+        # to disk as soon as it is done so that they are not all in memory
+        async with self.repository_limit:
+            packages = await self.fetch_and_record(repository, assets)
+            await asyncio.to_thread(spool.add, source, itertools.chain.from_iterable(packages.values()))
+
+
+async def get_packages_async(
+    client: Client,
+    repositories: list[Repository],
+    cache: Cache,
+    backend: str,
+    merge_duplicates: bool,
+    limit: int,
+    host_limit: int,
+    spool: Optional[PackageSpool] = None,
+) -> dict[str, set[Package]]:
+    # make sure that there is a thread available for every request we allow
+    asyncio.get_running_loop().set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=limit))
+
+    fetcher = AsyncFetcher(client, cache, limit, host_limit)
+    if backend == "graphql":
+        # list everything up front in as few requests as possible
+        releases = await fetcher.call(client.graphql_url, get_releases_graphql, client, repositories)
+        order = repositories
+    else:
+        # start the cheapest repositories first
+        releases = {}
+        order = order_repositories(repositories, cache)
+
+    packages: dict[str, set[Package]] = {}
+    if spool is not None:
+        # the spool knows where each repository is in the list so they can be
+        # added in whatever order they finish
+        sources = {repository: index for index, repository in enumerate(repositories)}
+        await asyncio.gather(
+            *(fetcher.fetch_and_spool(x, releases.pop(x, None), spool, sources[x]) for x in order),
+        )
+        return packages
+
+    # otherwise merge them in the same order as the list of repositories
+    tasks = {x: asyncio.create_task(fetcher.fetch_and_record(x, releases.pop(x, None))) for x in order}
+    for repository in repositories:
+        merge_packages(packages, await tasks.pop(repository), merge_duplicates)
+
+    return packages
+
+
+@statistics.timer("upload_metadata")
+def upload_metadata_file(client: Client, package: Package, data: bytes) -> None:
+    # release asset urls look like this:
+    # https://github.com/{owner}/{repo}/releases/download/{tag}/{filename}
+    parts = urllib.parse.urlsplit(package.url).path.split("/")
+    if len(parts) != 7 or parts[3:5] != ["releases", "download"]:
+        raise ValueError(f"not a github release asset: {package.url}")
+
+    owner, repo, tag = parts[1], parts[2], urllib.parse.unquote(parts[5])
+    logger.info("uploading metadata for %s to %s/%s release %s", package.filename, owner, repo, tag)
+
+    # one request to find the release and one to upload to it
+    client.limiter.wait("core", 2)
+    release = client.github.get_repo(f"{owner}/{repo}").get_release(tag)
+    release.upload_asset_from_memory(
+        io.BytesIO(data),
+        len(data),
+        f"{package.filename}.metadata",
+        content_type="text/plain",
+    )
+
 
-            # expecting a binary response
-            hasher = hashlib.sha256()
-            for chunk in response.iter_content(chunk_size=1024):
-                if chunk:  # filter out keep-alive new chunks
-                    hasher.update(chunk)
+def get_package_metadata(client: Client, package: Package, cache: Cache) -> Optional[bytes]:
+    # we did not download this wheel so only get the bits of it that we need
+    try:
+        data = get_remote_wheel_metadata(client.session, package.url)
+    except (requests.RequestException, zipfile.BadZipFile, ValueError) as e:
+        logger.warning("unable to read metadata from %s: %s", package.filename, e)
+        return None
+
+    cache.set_metadata(package.sha256, data)
+    return data
+
+
+def publish_metadata(client: Client, packages: MutableMapping[str, set[Package]], cache: Cache) -> None:
+    # https://peps.python.org/pep-0658/ wants the core metadata for a wheel
+    # to be right next to it so we attach it to the release with the wheel
+    for name in list(packages):
+        files = packages[name]
+        updated = set()
+        for package in files:
+            if package.filename.endswith(".whl") and package.metadata_sha256 is None:
+                data = cache.get_metadata(package.sha256) or get_package_metadata(client, package, cache)
+                if data is not None:
+                    try:
+                        upload_metadata_file(client, package, data)
+                    except (ValueError, github.GithubException) as e:
+                        logger.warning("unable to upload metadata for %s: %s", package.filename, e)
+                    else:
+                        statistics.increment("metadata_files_uploaded")
+                        package = package._replace(metadata_sha256=hashlib.sha256(data).hexdigest())
+            updated.add(package)
+
+        if updated != files:
+            packages[name] = updated
+
+
+@contextlib.contextmanager
+def profiling(path: str) -> Iterator[None]:
+    # depending on the version of python this may only see the thread that it
+    # was started in, so work done in a pool of threads can show up as time
+    # spent waiting for that pool. the timers in the statistics see them all.
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
 
-            result["sha256"] = hasher.hexdigest()
 
-        yield Artifact(**result)
+@contextlib.contextmanager
+def reporting(stats_json: Optional[str] = None, metrics: Optional[str] = None) -> Iterator[None]:
+    # these are written when we are done, even if we did not finish
+    success = False
+    try:
+        yield
+        success = True
+    finally:
+        if stats_json is not None:
+            statistics.save(stats_json, success)
+
+        # not being able to report on a run is not a reason for it to fail
+        if metrics is not None:
+            try:
+                save_prometheus_metrics(metrics, statistics.as_dict(), success)
+            except (OSError, requests.RequestException) as e:
+                logger.warning("unable to save metrics to %s: %s", metrics, e)
 
 
 def run(
@@ -404,30 +2478,189 @@ def run(
     token_stdin: bool,
     title: Optional[str] = None,
     merge_duplicates: Optional[bool] = None,
+    jobs: Optional[int] = None,
+    cache: Optional[str] = None,
+    incremental: Optional[bool] = None,
+    backend: Optional[str] = None,
+    pool_size: Optional[int] = None,
+    retries: Optional[int] = None,
+    backoff: Optional[float] = None,
+    download_jobs: Optional[int] = None,
+    build_jobs: Optional[int] = None,
+    shard_index: Optional[bool] = None,
+    use_async: Optional[bool] = None,
+    async_requests: Optional[int] = None,
+    async_host_requests: Optional[int] = None,
+    precompress: Optional[bool] = None,
+    upload_metadata: Optional[bool] = None,
+    stream: Optional[bool] = None,
+    stats_json: Optional[str] = None,
+    profile: Optional[str] = None,
+    metrics: Optional[str] = None,
+    request_interval: Optional[float] = None,
 ) -> None:
     if merge_duplicates is None:
         merge_duplicates = False
 
-    packages = {}
+    if incremental is None:
+        incremental = False
+
+    if backend is None:
+        backend = "rest"
+    if backend not in ("rest", "graphql"):
+        raise ValueError(f"invalid backend: {backend}")
+
+    if jobs is None:
+        jobs = 1
+    if jobs < 1:
+        raise ValueError(f"invalid number of jobs: {jobs}")
+
+    if download_jobs is None:
+        download_jobs = 4
+    if download_jobs < 1:
+        raise ValueError(f"invalid number of download jobs: {download_jobs}")
+
+    if build_jobs is None:
+        build_jobs = 1
+    if build_jobs < 1:
+        raise ValueError(f"invalid number of build jobs: {build_jobs}")
+
+    if shard_index is None:
+        shard_index = False
+
+    if use_async is None:
+        use_async = False
+
+    if precompress is None:
+        precompress = False
+
+    if upload_metadata is None:
+        upload_metadata = False
+
+    if stream is None:
+        stream = False
+
+    if async_requests is None:
+        async_requests = 32
+    if async_requests < 1:
+        raise ValueError(f"invalid number of requests: {async_requests}")
+
+    if async_host_requests is None:
+        async_host_requests = 8
+    if async_host_requests < 1:
+        raise ValueError(f"invalid number of requests per host: {async_host_requests}")
+
+    # a run with one job goes as fast as pygithub does by default and every
+    # extra job makes it go that much faster, just like when every job had
+    # its own client
+    if request_interval is None:
+        request_interval = REQUEST_INTERVAL / (async_host_requests if use_async else jobs)
+    if request_interval < 0:
+        raise ValueError(f"invalid request interval: {request_interval}")
+
+    # make sure that there is a connection available for every job
+    if pool_size is None:
+        pool_size = max(10, async_host_requests) if use_async else max(10, jobs + download_jobs)
+
+    if retries is None:
+        retries = 3
+
+    if backoff is None:
+        backoff = 0.5
+
     token = get_github_token(token, token_stdin)
-    for repository in load_repositories(repositories):
-        # this creates a dictionary of sets
-        # the key is the name of the package
-        # the value is a set of packages
-        data = create_packages(get_artifacts(token, repository))
-
-        for key, value in data.items():
-            logger.info("found %d files for package %s", len(value), key)
-            if merge_duplicates:
-                # if this key is already in the dict then merge the packages
-                packages[key] = packages.get(key, set()) | value
+    statistics.reset()
+
+    # digests are cached between runs if the user has given us a place to put them
+    digest_cache = Cache(cache, metadata=upload_metadata)
+
+    with contextlib.ExitStack() as stack:
+        if profile is not None:
+            stack.enter_context(profiling(profile))
+        stack.enter_context(reporting(stats_json, metrics))
+        stack.enter_context(statistics.timer("total"))
+
+        # packages are kept on disk until they are built if we were asked to
+        spool = stack.enter_context(PackageSpool(merge_duplicates)) if stream else None
+
+        # every request goes through this so that connections are reused
+        with (
+            Client(token, pool_size, retries, backoff, download_jobs, request_interval) as client,
+            statistics.timer("fetch"),
+        ):
+            client.limiter.start(client.github.requester)
+
+            if use_async:
+                packages = asyncio.run(
+                    get_packages_async(
+                        client,
+                        list(load_repositories(repositories)),
+                        digest_cache,
+                        backend,
+                        merge_duplicates,
+                        async_requests,
+                        async_host_requests,
+                        spool,
+                    ),
+                )
             else:
-                # if this key is already in the dict then replace it
-                packages[key] = value
+                packages = get_packages(
+                    client,
+                    list(load_repositories(repositories)),
+                    digest_cache,
+                    backend,
+                    jobs,
+                    merge_duplicates,
+                    spool,
+                )
+
+            if upload_metadata:
+                with statistics.timer("publish_metadata"):
+                    publish_metadata(client, packages if spool is None else spool, digest_cache)
+
+            for resource, used in sorted(client.limiter.used().items()):
+                logger.info("used %d requests from the %s rate limit", used, resource)
+                statistics.increment(f"rate_limit_used_{resource}", used)
+            for resource, left in sorted(client.limiter.left().items()):
+                statistics.increment(f"rate_limit_remaining_{resource}", left)
+
+        # only save the cache once every repository has been seen so that we do
+        # not evict entries for repositories that we never got to
+        digest_cache.save()
+
+        counters = statistics.counters
+        logger.info("found %d repositories with releases that had not changed", counters["releases_not_modified"])
+        logger.info(
+            "found digests for %d files from github, %d from the cache, %d from checksum files, and %d from downloads",
+            counters["digests_from_github"],
+            counters["digests_from_cache"],
+            counters["digests_from_sha256sums"],
+            counters["digests_from_download"],
+        )
+        logger.info(
+            "downloaded %d bytes to calculate digests and avoided downloading %d bytes",
+            counters["download_bytes"],
+            counters["download_bytes_avoided"],
+        )
 
-    # set a default title
-    if title is None:
-        title = "My Private PyPI"
+        # set a default title
+        if title is None:
+            title = "My Private PyPI"
+
+        # this actually spits out HTML files
+        with statistics.timer("build"):
+            build(
+                packages if spool is None else spool,
+                output,
+                title,
+                incremental,
+                build_jobs,
+                shard_index,
+                precompress,
+            )
 
-    # this actually spits out HTML files
-    build(packages, output, title)
+        logger.info(
+            "wrote %d files and skipped %d packages that had not changed",
+            counters["files_written"],
+            counters["packages_skipped"],
+        )
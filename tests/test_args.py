@@ -30,6 +30,23 @@ def test_valid_values():
         ],
     )
     assert not x.verbose
+    assert x.jobs == 1
+    assert x.cache is None
+    assert not x.incremental
+    assert x.backend == "rest"
+    assert x.pool_size is None
+    assert x.retries == 3
+    assert x.request_interval is None
+    assert x.download_jobs == 4
+    assert x.build_jobs == 1
+    assert not x.shard_index
+    assert not x.precompress
+    assert not x.upload_metadata
+    assert not x.stream
+    assert x.stats_json is None
+    assert x.profile is None
+    assert x.metrics is None
+    assert not x.use_async
     assert x.title == "My Private PyPI"
     assert x.output == "/path/to/output"
     assert x.repositories == "/path/to/repos.txt"
@@ -52,3 +69,18 @@ def test_valid_values():
     assert x.repositories == "/path/to/repos.txt"
     assert not x.token_stdin
     assert x.token == "asdf"  # noqa: S105
+
+
+def test_jobs():
+    x = ghpypi.parse_arguments(
+        [
+            "--token-stdin",
+            "--output",
+            "/path/to/output",
+            "--repositories",
+            "/path/to/repos.txt",
+            "--jobs",
+            "8",
+        ],
+    )
+    assert x.jobs == 8
@@ -1,12 +1,28 @@
+import asyncio
+import collections
+import concurrent.futures
+import copy
+import gzip
 import hashlib
+import http.server
 import io
+import json
 import os
+import pickle  # noqa: S403
+import pstats
+import re
+import threading
+import time
+import urllib.parse
+import zipfile
 from datetime import datetime
 from pathlib import PosixPath
+from typing import Callable
 
 import github
 import packaging.version
 import pytest
+import requests
 import responses
 from pytest_mock import MockerFixture
 
@@ -241,70 +257,76 @@ def test_github_tokens(mocker: MockerFixture):
         ghpypi.get_github_token(None, False)
 
 
-def test_get_artifacts(mocker: MockerFixture):
+# pygithub adds the port number to the urls that it requests
+RELEASES_URL = re.compile(r"https://api\.github\.com(:443)?/repos/paullockaby/ghpypi/releases")
+
+RELEASE_ASSET = {
+    "id": 1,
+    "name": "ghpypi-1.0.1.tar.gz",
+    "browser_download_url": "https://github.com/paullockaby/ghpypi/releases/download/v1.0.1/ghpypi-1.0.1.tar.gz",
+    "digest": "sha256:fa6dfbe92d7b150b788da980d53f07e6e84c4079118783d5905a72cc9b636ba3",
+    "size": 100,
+    "updated_at": "2021-12-25T06:22:19Z",
+    "uploader": {"login": "github-actions[bot]"},
+}
+
+
+@responses.activate
+def test_get_artifacts():
     # fake our access to github
     token = "abcdefghijklmnopqrstuvwxyz1234567890"  # noqa
     repository = ghpypi.Repository("paullockaby", "ghpypi")
 
-    # test releases returning nothing ... here is what we're doing here:
-    # our code needs to get a repository from a "github.Github" class which
-    # is actually "github.MainClass.Github". So we're going to patch the
-    # "get_repo" function on "github.MainClass.Github" class. we're going to
-    # make it return a second mock that imitates a "github.Repository.Repository"
-    # object implements the "get_releases" function and makes it return an
-    # empty list. that is all.
-    mock_get_repo = mocker.Mock(
-        spec=github.Repository.Repository,
-        **{
-            "get_releases.return_value": [],
-        },
-    )
-    mocker.patch("github.MainClass.Github.get_repo", return_value=mock_get_repo)
-    releases = list(ghpypi.get_artifacts(token, repository))
+    # test releases returning nothing
+    responses.get(RELEASES_URL, json=[])
+    releases = list(ghpypi.get_artifacts(ghpypi.Client(token), repository))
     assert len(releases) == 0
 
-    # test releases returning something with no asset keyword.
-    # much like the last example, except that when we call "get_releases" on
-    # the "github.Repository.Repository" class, we need it to return another
-    # mock that implements "github.GitRelease.GitRelease" and then we want to
-    # mock the "raw_data" function and have it return an empty dict.
-    mock_get_repo = mocker.Mock(
-        spec=github.Repository.Repository,
-        **{
-            "get_releases.return_value": [
-                mocker.Mock(
-                    spec=github.GitRelease.GitRelease,
-                    **{
-                        "raw_data": {},
-                    },
-                ),
-            ],
-        },
-    )
-    mocker.patch("github.MainClass.Github.get_repo", return_value=mock_get_repo)
-    releases = list(ghpypi.get_artifacts(token, repository))
+    # test releases returning something with no asset keyword
+    responses.replace(responses.GET, RELEASES_URL, json=[{}])
+    releases = list(ghpypi.get_artifacts(ghpypi.Client(token), repository))
     assert len(releases) == 0
 
-    # test releases returning something with no assets.
-    # this is exactly like the last example, except that we are putting things
-    # into the dict that is being returned when "raw_data" is called.
-    mock_get_repo = mocker.Mock(
-        spec=github.Repository.Repository,
-        **{
-            "get_releases.return_value": [
-                mocker.Mock(
-                    spec=github.GitRelease.GitRelease,
-                    **{
-                        "raw_data": {"assets": []},
-                    },
-                ),
-            ],
-        },
-    )
-    mocker.patch("github.MainClass.Github.get_repo", return_value=mock_get_repo)
-    releases = list(ghpypi.get_artifacts(token, repository))
+    # test releases returning something with no assets
+    responses.replace(responses.GET, RELEASES_URL, json=[{"assets": []}])
+    releases = list(ghpypi.get_artifacts(ghpypi.Client(token), repository))
     assert len(releases) == 0
 
+    # a repository that does not exist is an error
+    responses.replace(responses.GET, RELEASES_URL, status=404, json={"message": "Not Found"})
+    with pytest.raises(github.UnknownObjectException):
+        list(ghpypi.get_artifacts(ghpypi.Client(token), repository))
+
+
+@responses.activate
+def test_get_releases_pages():
+    token = "abcdefghijklmnopqrstuvwxyz1234567890"  # noqa
+    repository = ghpypi.Repository("paullockaby", "ghpypi")
+
+    # every page comes with the assets for its releases so that is all we ask for
+    next_url = "https://api.github.com/repositories/1/releases?per_page=100&page=2"
+    responses.get(
+        RELEASES_URL,
+        match=[responses.matchers.query_param_matcher({"per_page": "100"})],
+        json=[{"assets": [RELEASE_ASSET]}],
+        headers={"Link": f'<{next_url}>; rel="next", <{next_url}>; rel="last"'},
+    )
+    responses.get(
+        re.compile(r"https://api\.github\.com(:443)?/repositories/1/releases"),
+        match=[responses.matchers.query_param_matcher({"per_page": "100", "page": "2"})],
+        json=[{"assets": [dict(RELEASE_ASSET, id=2, name="ghpypi-1.0.0.tar.gz")]}, {"assets": []}],
+    )
+
+    # the next page is not asked for until we get to it
+    releases = ghpypi.get_releases(ghpypi.Client(token), repository)
+    assert len(responses.calls) == 1
+    assert [[x["name"] for x in assets] for assets in releases.assets] == [
+        ["ghpypi-1.0.1.tar.gz"],
+        ["ghpypi-1.0.0.tar.gz"],
+        [],
+    ]
+    assert len(responses.calls) == 2
+
 
 def test_create_packages_empty():
     assert not ghpypi.create_packages([])
@@ -609,6 +631,7 @@ def test_sorting():
         )
     ]
     sorted_names = [package.filename for package in sorted(test_packages)]
+    assert [package.filename for package in ghpypi.sort_packages(test_packages)] == sorted_names
     assert sorted_names == [
         "aspy.yaml-0.2.0-py2-none-any.whl",
         "aspy.yaml-0.2.1-py2-none-any.whl",
@@ -731,3 +754,1373 @@ def test_create_artifacts_digest():
             uploaded_by="github-actions[bot]",
         ),
     ]
+
+
+@pytest.mark.parametrize("merge_duplicates", (False, True))
+def test_run_jobs(mocker: MockerFixture, tmp_path: PosixPath, merge_duplicates: bool):
+    repositories = tmp_path / "repositories.txt"
+    repositories.write_text("\n".join(f"paullockaby/repo{i}" for i in range(10)))
+
+    def get_artifacts(client, repository, cache=None):
+        # finish the repositories in reverse order to shake out any ordering problems
+        index = int(repository.name[4:])
+        time.sleep((10 - index) / 1000)
+        yield Artifact(
+            filename=f"ghpypi-1.0.{index}.tar.gz",
+            url=f"https://github.com/paullockaby/{repository.name}/releases/download/v1.0.{index}/ghpypi-1.0.{index}.tar.gz",
+            sha256="fa6dfbe92d7b150b788da980d53f07e6e84c4079118783d5905a72cc9b636ba3",
+            uploaded_at=datetime(2021, 12, 25, 6, 16, 9),
+            uploaded_by="github-actions[bot]",
+        )
+
+    mocker.patch("ghpypi.ghpypi.get_artifacts", side_effect=get_artifacts)
+    mocker.patch("ghpypi.ghpypi.RateLimiter.start")
+
+    # spooled packages are gone once the run is over so look at them while we can
+    results = []
+    mocker.patch("ghpypi.ghpypi.build", side_effect=lambda packages, *args: results.append(dict(packages.items())))
+
+    for jobs, stream in ((1, False), (4, False), (1, True), (4, True)):
+        ghpypi.run(
+            str(repositories),
+            str(tmp_path),
+            "token",
+            False,
+            merge_duplicates=merge_duplicates,
+            jobs=jobs,
+            stream=stream,
+        )
+
+    assert results[0] == results[1] == results[2] == results[3]
+    versions = sorted(str(x.version) for x in results[0]["ghpypi"])
+    if merge_duplicates:
+        assert versions == [f"1.0.{i}" for i in range(10)]
+    else:
+        assert versions == ["1.0.9"]
+
+    with pytest.raises(ValueError):
+        ghpypi.run(str(repositories), str(tmp_path), "token", False, jobs=0)
+
+    with pytest.raises(ValueError):
+        ghpypi.run(str(repositories), str(tmp_path), "token", False, request_interval=-1)
+
+
+def test_statistics_timer():
+    statistics = ghpypi.Statistics()
+    with statistics.timer("sleep"):
+        time.sleep(0.01)
+
+    @statistics.timer("sleep")
+    def sleep():
+        time.sleep(0.01)
+
+    sleep()
+    statistics.increment("files_written", 3)
+
+    data = statistics.as_dict()
+    assert data["counters"] == {"files_written": 3}
+    assert 0.02 <= data["timers"]["sleep"] < 1
+
+    statistics.reset()
+    assert statistics.as_dict() == {"counters": {}, "timers": {}, "repositories": {}}
+
+
+def test_run_stats_json(mocker: MockerFixture, tmp_path: PosixPath):
+    repositories = tmp_path / "repositories.txt"
+    repositories.write_text("paullockaby/ghpypi\n")
+
+    def get_artifacts(client, repository, cache=None):
+        yield Artifact(
+            filename="ghpypi-1.0.0.tar.gz",
+            url="https://github.com/paullockaby/ghpypi/releases/download/v1.0.0/ghpypi-1.0.0.tar.gz",
+            sha256="fa6dfbe92d7b150b788da980d53f07e6e84c4079118783d5905a72cc9b636ba3",
+            uploaded_at=datetime(2021, 12, 25, 6, 16, 9),
+            uploaded_by="github-actions[bot]",
+        )
+
+    mocker.patch("ghpypi.ghpypi.get_artifacts", side_effect=get_artifacts)
+    mocker.patch("ghpypi.ghpypi.RateLimiter.start")
+
+    output = tmp_path / "output"
+    stats_json = tmp_path / "stats.json"
+    profile = tmp_path / "run.prof"
+    metrics = tmp_path / "ghpypi.prom"
+    ghpypi.run(
+        str(repositories),
+        str(output),
+        "token",
+        False,
+        stats_json=str(stats_json),
+        profile=str(profile),
+        metrics=str(metrics),
+    )
+
+    data = json.loads(stats_json.read_text())
+    assert data["success"]
+    assert data["counters"]["files_written"] == 3
+    assert data["repositories"]["paullockaby/ghpypi"]["files"] == 1
+    assert {"total", "fetch", "parse", "sort", "render", "build"} <= data["timers"].keys()
+    assert data["timers"]["total"] >= data["timers"]["build"]
+
+    # the profile can be loaded by the standard library
+    stats = pstats.Stats(str(profile))
+    assert any(function == "build" for _, _, function in stats.stats)
+
+    lines = metrics.read_text().splitlines()
+    assert "# TYPE ghpypi_run_duration_seconds gauge" in lines
+    assert "ghpypi_run_success 1" in lines
+    assert "ghpypi_files_written 3" in lines
+    assert 'ghpypi_repository_files{repository="paullockaby/ghpypi"} 1' in lines
+    assert any(line.startswith('ghpypi_repository_fetch_seconds{repository="paullockaby/ghpypi"} ') for line in lines)
+    assert any(line.startswith('ghpypi_phase_seconds{phase="render"} ') for line in lines)
+
+    # a run that fails still says so
+    mocker.patch("ghpypi.ghpypi.build", side_effect=OSError("disk full"))
+    with pytest.raises(OSError):
+        ghpypi.run(str(repositories), str(output), "token", False, stats_json=str(stats_json), metrics=str(metrics))
+    assert not json.loads(stats_json.read_text())["success"]
+    assert "ghpypi_run_success 0" in metrics.read_text().splitlines()
+
+
+@responses.activate
+def test_save_prometheus_metrics_push():
+    responses.add(responses.PUT, "http://localhost:9091/metrics/job/ghpypi", status=200)
+    data = {
+        "counters": {"digests_from_cache": 2, "rate_limit_used_core": 5, "download_bytes": 100},
+        "timers": {"total": 1.5, "download_digests": 0.25},
+        "repositories": {'paul"lockaby/ghpypi': {"seconds": 0.5, "files": 4}},
+    }
+    ghpypi.save_prometheus_metrics("http://localhost:9091/", data, success=False)
+
+    assert len(responses.calls) == 1
+    assert responses.calls[0].request.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    lines = responses.calls[0].request.body.decode().splitlines()
+    assert "ghpypi_run_success 0" in lines
+    assert "ghpypi_run_duration_seconds 1.5" in lines
+    assert 'ghpypi_phase_seconds{phase="download_digests"} 0.25' in lines
+    assert 'ghpypi_digests{source="cache"} 2' in lines
+    assert 'ghpypi_rate_limit_used{resource="core"} 5' in lines
+    assert "ghpypi_download_bytes 100" in lines
+    assert 'ghpypi_repository_files{repository="paul\\"lockaby/ghpypi"} 4' in lines
+
+
+@responses.activate
+def test_create_artifacts_cache(tmp_path: PosixPath):
+    assets = [
+        {
+            "id": 1,
+            "name": "sha256sum.txt",
+            "browser_download_url": "https://github.com/paullockaby/ghpypi/releases/download/v1.0.1/sha256sum.txt",
+            "size": 100,
+            "updated_at": "2021-12-25T06:22:19Z",
+            "uploader": {"login": "github-actions[bot]"},
+        },
+        {
+            "id": 2,
+            "name": "ghpypi-1.0.1-py3-none-any.whl",
+            "browser_download_url": "https://github.com/paullockaby/ghpypi/releases/download/v1.0.1/ghpypi-1.0.1-py3-none-any.whl",
+            "size": 16,
+            "updated_at": "2021-12-25T06:22:19Z",
+            "uploader": {"login": "github-actions[bot]"},
+        },
+        {
+            "id": 3,
+            "name": "ghpypi-1.0.1.tar.gz",
+            "browser_download_url": "https://github.com/paullockaby/ghpypi/releases/download/v1.0.1/ghpypi-1.0.1.tar.gz",
+            "size": 16,
+            "updated_at": "2021-12-25T06:22:19Z",
+            "uploader": {"login": "github-actions[bot]"},
+        },
+    ]
+
+    asset_data = b"this is an asset"
+    asset_digest = hashlib.sha256(asset_data).hexdigest()
+    responses.get(
+        assets[0]["browser_download_url"],
+        f"{asset_digest} ghpypi-1.0.1.tar.gz\n".encode("ascii"),
+    )
+    responses.get(assets[1]["browser_download_url"], asset_data)
+
+    path = str(tmp_path / "cache" / "digests.json")
+    cache = ghpypi.Cache(path)
+    results = list(ghpypi.create_artifacts(assets, cache))
+    assert [x.sha256 for x in results] == [asset_digest, asset_digest]
+    assert len(responses.calls) == 2
+    cache.save()
+
+    # nothing changed so nothing gets downloaded, not even the checksums
+    cache = ghpypi.Cache(path)
+    assert [x.sha256 for x in ghpypi.create_artifacts(assets, cache)] == [asset_digest, asset_digest]
+    assert len(responses.calls) == 2
+
+    # a replaced asset gets looked up in the checksums and then downloaded again
+    assets[1] = {**assets[1], "size": 17, "updated_at": "2021-12-26T06:22:19Z"}
+    assert [x.sha256 for x in ghpypi.create_artifacts(assets, cache)] == [asset_digest, asset_digest]
+    assert len(responses.calls) == 4
+
+    # assets that we did not see are evicted
+    cache.save()
+    cache = ghpypi.Cache(path)
+    list(ghpypi.create_artifacts(assets[1:2], cache))
+    cache.save()
+    assert set(ghpypi.Cache(path).digests) == {"2"}
+
+
+def test_cache_invalid(tmp_path: PosixPath):
+    path = tmp_path / "digests.json"
+    path.write_text("this is not json")
+    assert ghpypi.Cache(str(path)).digests == {}
+
+    path.write_text('{"version": 0, "digests": {"1": {}}}')
+    assert ghpypi.Cache(str(path)).digests == {}
+
+
+@responses.activate
+def test_create_artifacts_github_digest():
+    asset_data = b"this is an asset"
+    asset_digest = hashlib.sha256(asset_data).hexdigest()
+
+    assets = [
+        {
+            "name": "sha256sum.txt",
+            "browser_download_url": "https://github.com/paullockaby/ghpypi/releases/download/v1.0.1/sha256sum.txt",
+            "size": 100,
+            "updated_at": "2021-12-25T06:22:19Z",
+            "uploader": {"login": "github-actions[bot]"},
+        },
+        {
+            "name": "ghpypi-1.0.1-py3-none-any.whl",
+            "browser_download_url": "https://github.com/paullockaby/ghpypi/releases/download/v1.0.1/ghpypi-1.0.1-py3-none-any.whl",
+            "digest": "sha256:ae36bbabd6424037f716c6a78f907d6f9b058ab399a042b2c8530087beca9c3c",
+            "size": 1000,
+            "updated_at": "2021-12-25T06:22:19Z",
+            "uploader": {"login": "github-actions[bot]"},
+        },
+        {
+            "name": "ghpypi-1.0.1.tar.gz",
+            "browser_download_url": "https://github.com/paullockaby/ghpypi/releases/download/v1.0.1/ghpypi-1.0.1.tar.gz",
+            "digest": "md5:b2f5e2e8a5bb3c8d7f0ea2c9a2e3e5f4",
+            "size": 16,
+            "updated_at": "2021-12-25T06:22:19Z",
+            "uploader": {"login": "github-actions[bot]"},
+        },
+    ]
+
+    # the checksum file does not know about our tarball so it gets downloaded
+    responses.get(assets[0]["browser_download_url"], b"")
+    responses.get(assets[2]["browser_download_url"], asset_data)
+
+    ghpypi.statistics.reset()
+    results = list(ghpypi.create_artifacts(assets))
+    assert [x.sha256 for x in results] == [
+        "ae36bbabd6424037f716c6a78f907d6f9b058ab399a042b2c8530087beca9c3c",
+        asset_digest,
+    ]
+    assert [x.request.url for x in responses.calls] == [
+        assets[0]["browser_download_url"],
+        assets[2]["browser_download_url"],
+    ]
+    assert ghpypi.statistics.counters["digests_from_github"] == 1
+    assert ghpypi.statistics.counters["digests_from_download"] == 1
+    assert ghpypi.statistics.counters["download_bytes"] == len(asset_data)
+    assert ghpypi.statistics.counters["download_bytes_avoided"] == 1000
+
+
+def test_build_incremental(mocker: MockerFixture, tmp_path: PosixPath):
+    packages = ghpypi.create_packages(
+        [
+            Artifact(
+                filename=filename,
+                url=f"https://github.com/paullockaby/ghpypi/releases/download/v1.0.0/{filename}",
+                sha256="fa6dfbe92d7b150b788da980d53f07e6e84c4079118783d5905a72cc9b636ba3",
+                uploaded_at=datetime(2021, 12, 25, 6, 16, 9),
+                uploaded_by="github-actions[bot]",
+            )
+            for filename in ("ghpypi-1.0.0.tar.gz", "testrepo-1.0.0.tar.gz", "testrepo-1.0.1.tar.gz")
+        ],
+    )
+
+    spy = mocker.spy(ghpypi, "build_package")
+    ghpypi.build(packages, str(tmp_path), "My Private PyPI", incremental=True)
+    assert sorted(x.args[2] for x in spy.call_args_list) == ["ghpypi", "testrepo"]
+    for name in ("ghpypi", "testrepo"):
+        assert (tmp_path / "simple" / name / "index.html").exists()
+        assert (tmp_path / "pypi" / name / "json").exists()
+    assert "testrepo" in (tmp_path / "index.html").read_text()
+
+    # nothing changed so nothing gets rebuilt
+    spy.reset_mock()
+    ghpypi.build(packages, str(tmp_path), "My Private PyPI", incremental=True)
+    assert spy.call_count == 0
+
+    # the title is only on the indexes so package pages are not rebuilt for it
+    ghpypi.build(packages, str(tmp_path), "Another PyPI", incremental=True)
+    assert spy.call_count == 0
+    assert "Another PyPI" in (tmp_path / "index.html").read_text()
+
+    # a missing page gets rebuilt even if nothing changed
+    (tmp_path / "pypi" / "ghpypi" / "json").unlink()
+    ghpypi.build(packages, str(tmp_path), "My Private PyPI", incremental=True)
+    assert [x.args[2] for x in spy.call_args_list] == ["ghpypi"]
+    assert (tmp_path / "pypi" / "ghpypi" / "json").exists()
+
+    # a changed package is rebuilt and a removed package is deleted
+    spy.reset_mock()
+    packages = {"testrepo": {x for x in packages["testrepo"] if str(x.version) == "1.0.1"}}
+    ghpypi.build(packages, str(tmp_path), "My Private PyPI", incremental=True)
+    assert [x.args[2] for x in spy.call_args_list] == ["testrepo"]
+    assert not (tmp_path / "simple" / "ghpypi").exists()
+    assert not (tmp_path / "pypi" / "ghpypi").exists()
+    assert "ghpypi" not in (tmp_path / "simple" / "index.html").read_text()
+
+    # not incremental means that everything gets rebuilt and nothing is
+    # spent on working out what changed
+    spy.reset_mock()
+    digest_spy = mocker.spy(ghpypi, "get_package_digest")
+    ghpypi.build(packages, str(tmp_path), "My Private PyPI")
+    assert [x.args[2] for x in spy.call_args_list] == ["testrepo"]
+    assert digest_spy.call_count == 0
+
+
+@responses.activate
+def test_get_artifacts_etag(tmp_path: PosixPath):
+    token = "abcdefghijklmnopqrstuvwxyz1234567890"  # noqa
+    repository = ghpypi.Repository("paullockaby", "ghpypi")
+
+    # first time through we get an etag and list everything from that one response
+    responses.get(RELEASES_URL, json=[{"assets": [RELEASE_ASSET]}], headers={"ETag": '"abc"'})
+    path = str(tmp_path / "cache.json")
+    cache = ghpypi.Cache(path)
+    expected = list(ghpypi.get_artifacts(ghpypi.Client(token), repository, cache))
+    assert len(expected) == 1
+    assert len(responses.calls) == 1
+    assert "If-None-Match" not in responses.calls[-1].request.headers
+    cache.save()
+
+    # second time through github tells us nothing changed
+    responses.replace(responses.GET, RELEASES_URL, status=304)
+    cache = ghpypi.Cache(path)
+    assert list(ghpypi.get_artifacts(ghpypi.Client(token), repository, cache)) == expected
+    assert len(responses.calls) == 2
+    assert responses.calls[-1].request.headers["If-None-Match"] == '"abc"'
+
+    # the digests for the unchanged releases are not evicted
+    cache.save()
+    cache = ghpypi.Cache(path)
+    assert set(cache.digests) == {"1"}
+    assert set(cache.releases) == {"paullockaby/ghpypi"}
+
+    # third time through something changed so we list everything again
+    responses.replace(responses.GET, RELEASES_URL, json=[{"assets": [RELEASE_ASSET]}], headers={"ETag": '"def"'})
+    assert list(ghpypi.get_artifacts(ghpypi.Client(token), repository, cache)) == expected
+    assert len(responses.calls) == 3
+    assert cache.releases["paullockaby/ghpypi"]["etag"] == '"def"'
+
+
+@responses.activate
+def test_get_releases_graphql():
+    # graphql goes to the same github as everything else
+    base_url = "https://github.example.com/api/v3"
+    url = "https://github.example.com/api/graphql"
+
+    def get_asset(name: str) -> dict:
+        return {
+            "databaseId": abs(hash(name)),
+            "name": name,
+            "downloadUrl": f"https://github.com/paullockaby/ghpypi/releases/download/v1.0.0/{name}",
+            "size": 100,
+            "updatedAt": "2021-12-25T06:22:19Z",
+            "digest": f"sha256:{hashlib.sha256(name.encode()).hexdigest()}",
+            "uploadedBy": {"login": "github-actions[bot]"},
+        }
+
+    def get_page(nodes: list, cursor: str = None) -> dict:
+        return {"pageInfo": {"hasNextPage": cursor is not None, "endCursor": cursor}, "nodes": nodes}
+
+    # repo1 has two pages of releases and one of its releases has two pages of assets
+    pages = {
+        ("repo1", None): get_page(
+            [{"id": "R1", "releaseAssets": get_page([get_asset("repo1-1.0.0.tar.gz")], "A1")}],
+            "C1",
+        ),
+        ("repo1", "C1"): get_page([{"id": "R2", "releaseAssets": get_page([get_asset("repo1-0.9.0.tar.gz")])}]),
+        ("R1", "A1"): get_page([get_asset("repo1-1.0.0-py3-none-any.whl")]),
+        ("repo2", None): get_page([{"id": "R3", "releaseAssets": get_page([get_asset("repo2-1.0.0.tar.gz")])}]),
+        ("repo3", None): get_page([]),
+    }
+
+    def callback(request):
+        body = json.loads(request.body)
+        assert request.headers["Authorization"] == "bearer token"
+        variables = body["variables"]
+        data = {}
+        i = 0
+        while f"cursor{i}" in variables:
+            if f"name{i}" in variables:
+                data[f"q{i}"] = {"releases": pages[(variables[f"name{i}"], variables[f"cursor{i}"])]}
+            else:
+                data[f"q{i}"] = {"releaseAssets": pages[(variables[f"id{i}"], variables[f"cursor{i}"])]}
+            i += 1
+        return 200, {}, json.dumps({"data": data})
+
+    responses.add_callback(responses.POST, url, callback=callback)
+
+    repositories = [ghpypi.Repository("paullockaby", f"repo{i}") for i in range(1, 4)]
+    releases = ghpypi.get_releases_graphql(ghpypi.Client("token", base_url=base_url), repositories, batch_size=2)
+    assert len(responses.calls) == 3
+    assert {k.name: [[x["name"] for x in assets] for assets in v] for k, v in releases.items()} == {
+        "repo1": [["repo1-1.0.0.tar.gz", "repo1-1.0.0-py3-none-any.whl"], ["repo1-0.9.0.tar.gz"]],
+        "repo2": [["repo2-1.0.0.tar.gz"]],
+        "repo3": [],
+    }
+
+    # these go through the same path as everything else
+    packages = ghpypi.create_packages_from_releases(releases[repositories[0]])
+    assert {x.filename for x in packages["repo1"]} == {
+        "repo1-1.0.0.tar.gz",
+        "repo1-1.0.0-py3-none-any.whl",
+        "repo1-0.9.0.tar.gz",
+    }
+    assert len(responses.calls) == 3
+
+
+@responses.activate
+def test_get_releases_graphql_errors():
+    url = "https://api.github.com/graphql"
+    repositories = [ghpypi.Repository("paullockaby", "nothing")]
+
+    responses.post(url, json={"data": {"q0": None}, "errors": [{"message": "Could not resolve to a Repository"}]})
+    with pytest.raises(ValueError, match="Could not resolve"):
+        ghpypi.get_releases_graphql(ghpypi.Client("token"), repositories)
+
+    responses.replace(responses.POST, url, json={"data": {"q0": None}})
+    with pytest.raises(ValueError, match="invalid repository"):
+        ghpypi.get_releases_graphql(ghpypi.Client("token"), repositories)
+
+
+@responses.activate
+def test_client():
+    with ghpypi.Client("token", pool_size=4, retries=2, backoff=0) as client:
+        adapter = client.session.get_adapter("https://github.com/")
+        assert adapter._pool_maxsize == 4
+        assert adapter.max_retries.total == 2
+
+        # failed requests are retried on the shared session
+        url = "https://github.com/paullockaby/ghpypi/releases/download/v1.0.1/ghpypi-1.0.1.tar.gz"
+        responses.get(url, status=503)
+        responses.get(url, body=b"this is an asset")
+        assert ghpypi.get_sha256(client.session, url) == hashlib.sha256(b"this is an asset").hexdigest()
+        assert len(responses.calls) == 2
+
+
+def test_client_graphql_url():
+    assert ghpypi.Client("token").graphql_url == "https://api.github.com/graphql"
+    assert ghpypi.Client("token", base_url="https://github.example.com/api/v3/").graphql_url == (
+        "https://github.example.com/api/graphql"
+    )
+
+
+@responses.activate
+def test_client_request_interval():
+    responses.get(re.compile(r"https://api\.github\.com(:443)?/rate_limit"), json={})
+    for interval, slow in ((0.2, True), (0, False)):
+        with ghpypi.Client("token", request_interval=interval) as client:
+            start = time.perf_counter()
+            for _ in range(3):
+                client.github.requester.requestJson("GET", "/rate_limit")
+            assert (time.perf_counter() - start >= 0.4) == slow
+
+
+@responses.activate
+def test_create_artifacts_parallel_downloads():
+    assets = [
+        {
+            "name": f"ghpypi-1.0.{i}.tar.gz",
+            "browser_download_url": f"https://github.com/paullockaby/ghpypi/releases/download/v1.0.{i}/ghpypi-1.0.{i}.tar.gz",
+            "updated_at": "2021-12-25T06:22:19Z",
+            "uploader": {"login": "github-actions[bot]"},
+        }
+        for i in range(20)
+    ]
+
+    # make every file different and bigger than a single chunk
+    for i, asset in enumerate(assets):
+        responses.get(asset["browser_download_url"], bytes([i]) * (ghpypi.DOWNLOAD_CHUNK_SIZE + 1))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(ghpypi.create_artifacts(assets, executor=executor))
+
+    assert [x.filename for x in results] == [x["name"] for x in assets]
+    assert [x.sha256 for x in results] == [
+        hashlib.sha256(bytes([i]) * (ghpypi.DOWNLOAD_CHUNK_SIZE + 1)).hexdigest() for i in range(20)
+    ]
+
+
+@pytest.mark.parametrize("merge_duplicates", (False, True))
+@responses.activate
+def test_get_packages_async(mocker: MockerFixture, merge_duplicates: bool):
+    repositories = [ghpypi.Repository("paullockaby", f"repo{i}") for i in range(5)]
+
+    def get_releases(client, repository, cache=None):
+        index = int(repository.name[4:])
+        return ghpypi.Releases(
+            assets=[
+                [
+                    {
+                        "name": f"ghpypi-1.{index}.{i}.tar.gz",
+                        "browser_download_url": f"https://github.com/paullockaby/{repository.name}/releases/download/v1.{index}.{i}/ghpypi-1.{index}.{i}.tar.gz",
+                        "updated_at": "2021-12-25T06:22:19Z",
+                        "uploader": {"login": "github-actions[bot]"},
+                    },
+                ]
+                for i in range(3)
+            ],
+        )
+
+    mocker.patch("ghpypi.ghpypi.get_releases", side_effect=get_releases)
+    responses.get(re.compile(r"https://github\.com/paullockaby/.*"), body=b"this is an asset")
+
+    # keep track of how many requests are running at once
+    running = collections.Counter()
+    most_running = collections.Counter()
+    original_get_sha256 = ghpypi.get_sha256
+
+    def get_sha256(session, url, cache=None):
+        running["all"] += 1
+        most_running["all"] = max(most_running["all"], running["all"])
+        time.sleep(0.01)
+        try:
+            return original_get_sha256(session, url, cache)
+        finally:
+            running["all"] -= 1
+
+    mocker.patch("ghpypi.ghpypi.get_sha256", side_effect=get_sha256)
+
+    with ghpypi.Client("token") as client:
+        expected = ghpypi.get_packages(client, repositories, ghpypi.Cache(), "rest", 1, merge_duplicates)
+        assert most_running["all"] == 1
+
+        packages = asyncio.run(
+            ghpypi.get_packages_async(client, repositories, ghpypi.Cache(), "rest", merge_duplicates, 10, 3),
+        )
+        assert packages == expected
+        assert most_running["all"] == 3
+
+        # when spooling, every repository goes to disk as soon as it is done
+        # and it does not matter which one finishes first
+        with ghpypi.PackageSpool(merge_duplicates) as spool:
+            packages = asyncio.run(
+                ghpypi.get_packages_async(
+                    client,
+                    repositories,
+                    ghpypi.Cache(),
+                    "rest",
+                    merge_duplicates,
+                    10,
+                    3,
+                    spool,
+                ),
+            )
+            assert packages == {}
+            assert dict(spool.items()) == expected
+
+
+def test_rate_limiter(mocker: MockerFixture):
+    mock_time = mocker.patch("time.time", return_value=1000)
+    mock_sleep = mocker.patch("time.sleep")
+
+    limiter = ghpypi.RateLimiter()
+
+    # nothing known means nothing to wait for
+    limiter.wait("core", 10)
+    assert mock_sleep.call_count == 0
+
+    limiter.update_from_headers(
+        {
+            "x-ratelimit-resource": "core",
+            "x-ratelimit-remaining": "10",
+            "x-ratelimit-limit": "5000",
+            "x-ratelimit-reset": "1100",
+        },
+    )
+    limiter.update_from_headers({})  # ignored
+
+    # we have enough for this
+    limiter.wait("core", 5)
+    assert mock_sleep.call_count == 0
+    assert limiter.remaining["core"] == (5, 1100)
+
+    # what github tells us replaces what we set aside
+    limiter.update("core", 10, 5000, 1100)
+    assert limiter.remaining["core"] == (10, 1100)
+    limiter.wait("core", 5)
+    assert limiter.remaining["core"] == (5, 1100)
+
+    # we do not have enough for this so wait until exactly after the reset
+    def sleep(seconds):
+        mock_time.return_value += seconds
+
+    mock_sleep.side_effect = sleep
+    limiter.wait("core", 6)
+    mock_sleep.assert_called_once_with(101)
+
+    # a new window started. what was spent before we first saw a window was
+    # not spent by us, so each window only counts the request that told us
+    # about it and what came after.
+    limiter.update("core", 4990, 5000, 4700)
+    assert limiter.used() == {"core": 1 + 1}
+    assert limiter.left() == {"core": 4990}
+
+    # a late response from the old one is believed but we do not wait for a
+    # reset that has already happened
+    limiter.update("core", 3, 5000, 1100)
+    assert limiter.remaining["core"] == (3, 1100)
+    limiter.wait("core", 6)
+    assert mock_sleep.call_count == 1
+
+
+@responses.activate
+def test_rate_limiter_start(mocker: MockerFixture):
+    mocker.patch("time.time", return_value=1000)
+    mock_sleep = mocker.patch("time.sleep")
+
+    token = "abcdefghijklmnopqrstuvwxyz1234567890"  # noqa
+    responses.get(
+        re.compile(r"https://api\.github\.com(:443)?/rate_limit"),
+        json={
+            "resources": {
+                "core": {"limit": 5000, "remaining": 4000, "reset": 3000},
+                "graphql": {"limit": 5000, "remaining": 4500, "reset": 2000},
+            },
+        },
+    )
+
+    with ghpypi.Client(token) as client:
+        client.limiter.start(client.github.requester)
+
+    # we asked about our token and not about our address
+    assert responses.calls[0].request.headers["Authorization"] == f"token {token}"
+    assert client.limiter.remaining == {"core": (4000, 3000), "graphql": (4500, 2000)}
+
+    # so there is plenty left for graphql and github keeps us up to date
+    client.limiter.wait("graphql", 26)
+    assert mock_sleep.call_count == 0
+    client.limiter.update("graphql", 4474, 5000, 2000, 26)
+    assert client.limiter.left() == {"core": 4000, "graphql": 4474}
+    assert client.limiter.used() == {"core": 0, "graphql": 26}
+
+    # a window that we did not ask about starts from what the first response
+    # says is left plus what that request cost
+    client.limiter.update("core", 2000, 5000, 6600, 1)
+    client.limiter.update("core", 1990, 5000, 6600, 1)
+    assert client.limiter.used() == {"core": 11, "graphql": 26}
+
+
+def test_rate_limiter_free_requests(mocker: MockerFixture):
+    mocker.patch("time.time", return_value=1000)
+    mock_sleep = mocker.patch("time.sleep")
+
+    # requests that do not cost anything, like a "304 Not Modified", give
+    # back what was set aside for them when their response comes in
+    limiter = ghpypi.RateLimiter()
+    limiter.update("core", 100, 5000, 4000)
+    for _ in range(51):
+        limiter.wait("core", 2)
+        limiter.update("core", 100, 5000, 4000)
+    assert mock_sleep.call_count == 0
+
+
+@responses.activate
+def test_expected_cost(tmp_path: PosixPath):
+    token = "abcdefghijklmnopqrstuvwxyz1234567890"  # noqa
+    repository = ghpypi.Repository("paullockaby", "ghpypi")
+    cache = ghpypi.Cache(str(tmp_path / "cache.json"))
+    responses.get(
+        RELEASES_URL,
+        json=[{"assets": [dict(RELEASE_ASSET, id=i)]} for i in range(5)],
+        headers={"ETag": '"abc"'},
+    )
+
+    # nothing known about a repository and a repository with five releases
+    # that changed both take exactly as many requests as we expected
+    for _ in range(2):
+        expected = ghpypi.get_expected_cost(repository, cache)
+        before = len(responses.calls)
+        list(ghpypi.get_artifacts(ghpypi.Client(token), repository, cache))
+        assert len(responses.calls) - before == expected == 1
+        assert cache.get_release_count(repository) == 5
+
+
+def test_order_repositories(tmp_path: PosixPath):
+    cache = ghpypi.Cache(str(tmp_path / "cache.json"))
+    repositories = [ghpypi.Repository("paullockaby", f"repo{i}") for i in range(3)]
+    cache.set_releases(repositories[0], "etag", [], [], 250)
+    cache.set_releases(repositories[2], "etag", [], [], 1)
+    assert [ghpypi.get_expected_cost(x, cache) for x in repositories] == [3, 1, 1]
+    assert ghpypi.order_repositories(repositories, cache) == [repositories[1], repositories[2], repositories[0]]
+
+
+def test_build_jobs(tmp_path: PosixPath):
+    packages = ghpypi.create_packages(
+        [
+            Artifact(
+                filename=f"package{i}-1.0.{j}.tar.gz",
+                url=f"https://github.com/paullockaby/ghpypi/releases/download/v1.0.{j}/package{i}-1.0.{j}.tar.gz",
+                sha256="fa6dfbe92d7b150b788da980d53f07e6e84c4079118783d5905a72cc9b636ba3",
+                uploaded_at=datetime(2021, 12, 25, 6, 16, 9),
+                uploaded_by="github-actions[bot]",
+            )
+            for i in range(20)
+            for j in range(5)
+        ],
+    )
+
+    def read_tree(path: PosixPath) -> dict:
+        return {str(x.relative_to(path)): x.read_bytes() for x in sorted(path.rglob("*")) if x.is_file()}
+
+    ghpypi.build(packages, str(tmp_path / "serial"), "My Private PyPI")
+    ghpypi.build(packages, str(tmp_path / "parallel"), "My Private PyPI", jobs=4)
+    serial = read_tree(tmp_path / "serial")
+    assert len(serial) == 20 * 3 + 3
+    assert serial == read_tree(tmp_path / "parallel")
+
+
+def test_build_shared_environment(tmp_path: PosixPath):
+    assert ghpypi.get_jinja_env() is ghpypi.get_jinja_env()
+
+    # the title is not remembered from one build to the next
+    ghpypi.build({}, str(tmp_path / "first"), "First Title")
+    ghpypi.build({}, str(tmp_path / "second"), "Second Title")
+    assert "First Title" in (tmp_path / "first" / "index.html").read_text()
+    assert "Second Title" in (tmp_path / "second" / "index.html").read_text()
+    assert "First Title" not in (tmp_path / "second" / "index.html").read_text()
+
+
+def test_build_package_streaming(tmp_path: PosixPath):
+    files = sorted(
+        ghpypi.create_package(
+            Artifact(
+                filename=f"ghpypi-1.0.{i}.tar.gz",
+                url=f"https://github.com/paullockaby/ghpypi/releases/download/v1.0.{i}/ghpypi-1.0.{i}.tar.gz",
+                sha256="fa6dfbe92d7b150b788da980d53f07e6e84c4079118783d5905a72cc9b636ba3",
+                uploaded_at=datetime(2021, 12, 25, 6, 16, 9),
+                uploaded_by="github-actions[bot]",
+            ),
+        )
+        for i in range(1000)
+    )
+    template = ghpypi.get_jinja_env().get_template("package.html")
+    ghpypi.build_package(template, str(tmp_path), "ghpypi", files)
+    assert (tmp_path / "simple" / "ghpypi" / "index.html").read_text() == template.render(
+        package_name="ghpypi",
+        files=files,
+    )
+
+
+def test_build_shard_index(tmp_path: PosixPath):
+    packages = ghpypi.create_packages(
+        [
+            Artifact(
+                filename=filename,
+                url=f"https://github.com/paullockaby/ghpypi/releases/download/v1.0.0/{filename}",
+                sha256="fa6dfbe92d7b150b788da980d53f07e6e84c4079118783d5905a72cc9b636ba3",
+                uploaded_at=datetime(2021, 12, 25, 6, 16, 9),
+                uploaded_by="github-actions[bot]",
+            )
+            for filename in (
+                "aspy.yaml-0.2.1.tar.gz",
+                "apple-1.0.0.tar.gz",
+                "apple-1.1.0.tar.gz",
+                "banana-2.0.0.tar.gz",
+                "2to3-1.0.tar.gz",
+            )
+        ],
+    )
+
+    ghpypi.build(packages, str(tmp_path), "My Private PyPI", shard_index=True)
+    assert json.loads((tmp_path / "search.json").read_text()) == [
+        ["2to3", "1.0"],
+        ["apple", "1.1.0"],
+        ["aspy-yaml", "0.2.1"],
+        ["banana", "2.0.0"],
+    ]
+    assert sorted(x.name for x in (tmp_path / "index").iterdir()) == ["0-9.html", "a.html", "b.html"]
+
+    shard = (tmp_path / "index" / "a.html").read_text()
+    assert 'href="../simple/apple/index.html"' in shard
+    assert 'href="../simple/aspy-yaml/index.html"' in shard
+    assert "banana" not in shard.split('id="packages"')[1]
+
+    index = (tmp_path / "index.html").read_text()
+    assert 'href="index/b.html"' in index
+    assert "search.json" in index
+
+    # shards without any packages go away
+    del packages["banana"]
+    ghpypi.build(packages, str(tmp_path), "My Private PyPI", shard_index=True)
+    assert sorted(x.name for x in (tmp_path / "index").iterdir()) == ["0-9.html", "a.html"]
+
+
+def test_build_simple_json(tmp_path: PosixPath):
+    packages = ghpypi.create_packages(
+        [
+            Artifact(
+                filename=filename,
+                url=f"https://github.com/paullockaby/ghpypi/releases/download/v1.0.0/{filename}",
+                sha256="fa6dfbe92d7b150b788da980d53f07e6e84c4079118783d5905a72cc9b636ba3",
+                uploaded_at=datetime(2021, 12, 25, 6, 16, 9),
+                uploaded_by="github-actions[bot]",
+            )
+            for filename in ("ghpypi-1.0.1.tar.gz", "ghpypi-1.0.0.tar.gz", "aspy.yaml-0.2.1.tar.gz")
+        ],
+    )
+    ghpypi.build(packages, str(tmp_path), "My Private PyPI")
+
+    assert json.loads((tmp_path / "simple" / "index.json").read_text()) == {
+        "meta": {"api-version": "1.0"},
+        "projects": [{"name": "aspy-yaml"}, {"name": "ghpypi"}],
+    }
+    assert json.loads((tmp_path / "simple" / "ghpypi" / "index.json").read_text()) == {
+        "meta": {"api-version": "1.0"},
+        "name": "ghpypi",
+        "files": [
+            {
+                "filename": filename,
+                "url": f"https://github.com/paullockaby/ghpypi/releases/download/v1.0.0/{filename}",
+                "hashes": {"sha256": "fa6dfbe92d7b150b788da980d53f07e6e84c4079118783d5905a72cc9b636ba3"},
+            }
+            for filename in ("ghpypi-1.0.0.tar.gz", "ghpypi-1.0.1.tar.gz")
+        ],
+    }
+
+
+def test_build_precompress(tmp_path: PosixPath, mocker: MockerFixture):
+    # make sure that we only write gzip copies whether or not brotli is installed
+    mocker.patch.object(ghpypi, "brotli", None)
+
+    packages = ghpypi.create_packages(
+        [
+            Artifact(
+                filename=filename,
+                url=f"https://github.com/paullockaby/ghpypi/releases/download/v1.0.0/{filename}",
+                sha256="fa6dfbe92d7b150b788da980d53f07e6e84c4079118783d5905a72cc9b636ba3",
+                uploaded_at=datetime(2021, 12, 25, 6, 16, 9),
+                uploaded_by="github-actions[bot]",
+            )
+            for filename in ("ghpypi-1.0.1.tar.gz", "ghpypi-1.0.0.tar.gz", "aspy.yaml-0.2.1.tar.gz")
+        ],
+    )
+
+    ghpypi.statistics.reset()
+    ghpypi.build(packages, str(tmp_path), "My Private PyPI", incremental=True, precompress=True)
+
+    pages = sorted(p for p in tmp_path.rglob("*") if p.is_file() and p.suffix != ".gz" and p.name[0] != ".")
+    assert len(pages) == 9
+    for page in pages:
+        assert gzip.decompress(page.with_name(page.name + ".gz").read_bytes()) == page.read_bytes()
+    assert ghpypi.statistics.counters["files_compressed"] == 9
+
+    # the compressed copies are tracked so that they are cleaned up with the package
+    manifest = json.loads((tmp_path / ".ghpypi-manifest.json").read_text())
+    assert os.path.join("simple", "ghpypi", "index.html.gz") in manifest["packages"]["ghpypi"]["files"]
+
+    # nothing changed so nothing is compressed again
+    ghpypi.statistics.reset()
+    ghpypi.build(packages, str(tmp_path), "My Private PyPI", precompress=True)
+    assert ghpypi.statistics.counters["files_compressed"] == 0
+    assert ghpypi.statistics.counters["files_compression_skipped"] == 9
+
+    # only the page that changed is compressed again
+    ghpypi.statistics.reset()
+    ghpypi.build(packages, str(tmp_path), "A Different Title", precompress=True)
+    assert ghpypi.statistics.counters["files_compressed"] == 1
+    assert gzip.decompress((tmp_path / "index.html.gz").read_bytes()) == (tmp_path / "index.html").read_bytes()
+
+    # turning it off gets rid of the copies so that they are never served out of date
+    ghpypi.build(packages, str(tmp_path), "My Private PyPI", incremental=True)
+    assert not list(tmp_path.rglob("*.gz"))
+
+
+def test_precompress_file_brotli(tmp_path: PosixPath, mocker: MockerFixture):
+    class FakeCompressor:
+        def __init__(self):
+            self.data = b""
+
+        def process(self, data: bytes) -> bytes:
+            self.data += data
+            return b""
+
+        def finish(self) -> bytes:
+            return self.data[::-1]
+
+    mocker.patch.object(ghpypi, "brotli", mocker.Mock(Compressor=FakeCompressor))
+
+    path = tmp_path / "index.html"
+    path.write_text("<html></html>")
+    assert ghpypi.precompress_file(str(path)) == [".gz", ".br"]
+    assert (tmp_path / "index.html.br").read_bytes() == b"<html></html>"[::-1]
+    assert gzip.decompress((tmp_path / "index.html.gz").read_bytes()) == b"<html></html>"
+
+
+def make_wheel(metadata: bytes) -> bytes:
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w") as zf:
+        zf.writestr("ghpypi/__init__.py", "")
+        zf.writestr("ghpypi-1.0.1.dist-info/METADATA", metadata)
+        zf.writestr("ghpypi-1.0.1.dist-info/RECORD", "")
+    return data.getvalue()
+
+
+@responses.activate
+def test_create_artifacts_metadata():
+    metadata = b"Metadata-Version: 2.1\nName: ghpypi\nVersion: 1.0.1\n"
+    wheel_url = "https://github.com/paullockaby/ghpypi/releases/download/v1.0.1/ghpypi-1.0.1-py3-none-any.whl"
+    assets = [
+        {
+            "name": "ghpypi-1.0.1-py3-none-any.whl",
+            "browser_download_url": wheel_url,
+            "digest": "sha256:ae36bbabd6424037f716c6a78f907d6f9b058ab399a042b2c8530087beca9c3c",
+            "updated_at": "2021-12-25T06:22:19Z",
+            "uploader": {"login": "github-actions[bot]"},
+        },
+        {
+            "name": "ghpypi-1.0.1-py3-none-any.whl.metadata",
+            "browser_download_url": f"{wheel_url}.metadata",
+            "updated_at": "2021-12-25T06:22:19Z",
+            "uploader": {"login": "github-actions[bot]"},
+        },
+        {
+            # this one has no wheel so it is ignored
+            "name": "ghpypi-1.0.0-py3-none-any.whl.metadata",
+            "browser_download_url": f"{wheel_url}.metadata".replace("1.0.1", "1.0.0"),
+            "updated_at": "2021-12-25T06:22:19Z",
+            "uploader": {"login": "github-actions[bot]"},
+        },
+    ]
+
+    # the metadata file has no digest so it gets downloaded
+    responses.get(f"{wheel_url}.metadata", metadata)
+
+    ghpypi.statistics.reset()
+    assert list(ghpypi.create_artifacts(assets)) == [
+        Artifact(
+            filename="ghpypi-1.0.1-py3-none-any.whl",
+            url=wheel_url,
+            sha256="ae36bbabd6424037f716c6a78f907d6f9b058ab399a042b2c8530087beca9c3c",
+            uploaded_at=datetime(2021, 12, 25, 6, 22, 19),
+            uploaded_by="github-actions[bot]",
+            metadata_sha256=hashlib.sha256(metadata).hexdigest(),
+        ),
+    ]
+    assert len(responses.calls) == 1
+    assert ghpypi.statistics.counters["metadata_files"] == 1
+
+    # the async fetcher finds the same thing
+    with ghpypi.Client("token") as client:
+        fetcher = ghpypi.AsyncFetcher(client, ghpypi.Cache(), 4, 4)
+        results = asyncio.run(fetcher.create_artifacts(assets))
+    assert [x.metadata_sha256 for x in results] == [hashlib.sha256(metadata).hexdigest()]
+
+
+@responses.activate
+def test_get_sha256_wheel_metadata():
+    metadata = b"Metadata-Version: 2.1\nName: ghpypi\nVersion: 1.0.1\n"
+    wheel = make_wheel(metadata)
+    url = "https://github.com/paullockaby/ghpypi/releases/download/v1.0.1/ghpypi-1.0.1-py3-none-any.whl"
+    responses.get(url, wheel)
+    responses.get(f"{url}.txt", b"not a wheel")
+
+    # nothing is kept unless somebody asked for it
+    cache = ghpypi.Cache()
+    assert ghpypi.get_sha256(requests.Session(), url, cache) == hashlib.sha256(wheel).hexdigest()
+    assert cache.get_metadata(hashlib.sha256(wheel).hexdigest()) is None
+
+    cache = ghpypi.Cache(metadata=True)
+    assert ghpypi.get_sha256(requests.Session(), url, cache) == hashlib.sha256(wheel).hexdigest()
+    assert cache.get_metadata(hashlib.sha256(wheel).hexdigest()) == metadata
+
+    with pytest.raises(ValueError, match="unable to find core metadata"):
+        ghpypi.get_wheel_metadata(io.BytesIO(make_wheel(b"").replace(b"METADATA", b"NOTADATA")), "ghpypi.whl")
+
+
+def test_build_core_metadata(tmp_path: PosixPath):
+    metadata_sha256 = hashlib.sha256(b"Metadata-Version: 2.1\n").hexdigest()
+    packages = ghpypi.create_packages(
+        [
+            Artifact(
+                filename="ghpypi-1.0.1-py3-none-any.whl",
+                url="https://github.com/paullockaby/ghpypi/releases/download/v1.0.1/ghpypi-1.0.1-py3-none-any.whl",
+                sha256="fa6dfbe92d7b150b788da980d53f07e6e84c4079118783d5905a72cc9b636ba3",
+                uploaded_at=datetime(2021, 12, 25, 6, 16, 9),
+                uploaded_by="github-actions[bot]",
+                metadata_sha256=metadata_sha256,
+            ),
+        ],
+    )
+    ghpypi.build(packages, str(tmp_path), "My Private PyPI")
+
+    html = (tmp_path / "simple" / "ghpypi" / "index.html").read_text()
+    assert f'data-core-metadata="sha256={metadata_sha256}"' in html
+    assert f'data-dist-info-metadata="sha256={metadata_sha256}"' in html
+
+    files = json.loads((tmp_path / "simple" / "ghpypi" / "index.json").read_text())["files"]
+    assert files[0]["core-metadata"] == {"sha256": metadata_sha256}
+    assert files[0]["dist-info-metadata"] == {"sha256": metadata_sha256}
+
+
+def test_publish_metadata(mocker: MockerFixture):
+    metadata = b"Metadata-Version: 2.1\nName: ghpypi\nVersion: 1.0.1\n"
+    wheel = Package(
+        filename="ghpypi-1.0.1-py3-none-any.whl",
+        url="https://github.com/paullockaby/ghpypi/releases/download/v1.0.1/ghpypi-1.0.1-py3-none-any.whl",
+        sha256="ae36bbabd6424037f716c6a78f907d6f9b058ab399a042b2c8530087beca9c3c",
+        uploaded_at=datetime(2021, 12, 25, 6, 16, 9),
+        uploaded_by="github-actions[bot]",
+        name="ghpypi",
+        version=packaging.version.parse("1.0.1"),
+    )
+    sdist = wheel._replace(filename="ghpypi-1.0.1.tar.gz", url=wheel.url.replace("-py3-none-any.whl", ".tar.gz"))
+    packages = {"ghpypi": {wheel, sdist}}
+
+    cache = ghpypi.Cache(metadata=True)
+    cache.set_metadata(wheel.sha256, metadata)
+
+    client = mocker.MagicMock()
+    ghpypi.publish_metadata(client, packages, cache)
+
+    client.github.get_repo.assert_called_once_with("paullockaby/ghpypi")
+    client.github.get_repo.return_value.get_release.assert_called_once_with("v1.0.1")
+    upload = client.github.get_repo.return_value.get_release.return_value.upload_asset_from_memory
+    upload.assert_called_once()
+    assert upload.call_args.args[0].getvalue() == metadata
+    assert upload.call_args.args[2] == "ghpypi-1.0.1-py3-none-any.whl.metadata"
+    assert packages == {"ghpypi": {wheel._replace(metadata_sha256=hashlib.sha256(metadata).hexdigest()), sdist}}
+
+    # failures leave the package alone
+    upload.side_effect = github.GithubException(422, {"message": "already_exists"})
+    packages = {"ghpypi": {wheel}}
+    ghpypi.publish_metadata(client, packages, cache)
+    assert packages == {"ghpypi": {wheel}}
+
+
+class WheelHandler(http.server.BaseHTTPRequestHandler):
+    # serves one big wheel and only honors range requests if told to
+    wheel = b""
+    ranges = True
+
+    def do_GET(self):  # noqa: N802
+        data = self.wheel
+        match = re.match(r"bytes=(\d*)-(\d*)$", self.headers.get("Range") or "")
+        if match and self.ranges:
+            start, end = match.groups()
+            if not start:
+                start, end = max(0, len(data) - int(end)), len(data) - 1
+            start, end = int(start), min(int(end or len(data) - 1), len(data) - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+            end += 1
+            data = data[start:end]
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.mark.parametrize("ranges", (True, False))
+def test_get_remote_wheel_metadata(ranges: bool):
+    metadata = b"Metadata-Version: 2.1\nName: ghpypi\nVersion: 1.0.1\n"
+
+    # make the wheel big and hard to compress so that it is obvious when we download all of it
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w") as zf:
+        zf.writestr("ghpypi/big.bin", os.urandom(1024 * 1024))
+        zf.writestr("ghpypi-1.0.1.dist-info/METADATA", metadata)
+        zf.writestr("ghpypi-1.0.1.dist-info/RECORD", "")
+
+    handler = type("Handler", (WheelHandler,), {"wheel": data.getvalue(), "ranges": ranges})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        url = f"http://127.0.0.1:{server.server_port}/ghpypi-1.0.1-py3-none-any.whl"
+        ghpypi.statistics.reset()
+        assert ghpypi.get_remote_wheel_metadata(requests.Session(), url) == metadata
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    counters = ghpypi.statistics.counters
+    if ranges:
+        # everything we need is at the end of the file so one request is enough
+        assert counters["metadata_range_requests"] == 1
+        assert counters["metadata_range_bytes"] <= ghpypi.RANGE_REQUEST_SIZE
+        assert counters["metadata_full_downloads"] == 0
+    else:
+        assert counters["metadata_full_downloads"] == 1
+        assert counters["download_bytes"] == len(data.getvalue())
+
+
+def test_get_remote_wheel_metadata_redirect():
+    metadata = b"Metadata-Version: 2.1\nName: ghpypi\nVersion: 1.0.1\n"
+
+    # the metadata is at the start of a big wheel so that it takes a few range requests to get to it
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w") as zf:
+        zf.writestr("ghpypi-1.0.1.dist-info/METADATA", metadata)
+        zf.writestr("ghpypi/big.bin", os.urandom(1024 * 1024))
+
+    # like github, downloads get sent somewhere else
+    class RedirectHandler(WheelHandler):
+        wheel = data.getvalue()
+        paths: list[str] = []
+
+        def do_GET(self):  # noqa: N802
+            self.paths.append(self.path)
+            if self.path.startswith("/download/"):
+                self.send_response(302)
+                self.send_header("Location", self.path.replace("/download/", "/cdn/"))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            super().do_GET()
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RedirectHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        url = f"http://127.0.0.1:{server.server_port}/download/ghpypi-1.0.1-py3-none-any.whl"
+        assert ghpypi.get_remote_wheel_metadata(requests.Session(), url) == metadata
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # only the first request is redirected
+    assert [x for x in RedirectHandler.paths if x.startswith("/download/")] == [urllib.parse.urlsplit(url).path]
+    assert len([x for x in RedirectHandler.paths if x.startswith("/cdn/")]) > 1
+
+
+@responses.activate
+def test_get_remote_wheel_metadata_errors():
+    url = "https://github.com/paullockaby/ghpypi/releases/download/v1.0.1/ghpypi-1.0.1-py3-none-any.whl"
+
+    # a partial response that we can not make sense of is not the whole file
+    responses.get(url, status=206, body=b"not all of it")
+    with pytest.raises(ValueError, match="range"):
+        ghpypi.get_remote_wheel_metadata(requests.Session(), url)
+
+    responses.replace(responses.GET, url, status=404)
+    with pytest.raises(requests.HTTPError):
+        ghpypi.get_remote_wheel_metadata(requests.Session(), url)
+
+
+def test_range_file():
+    data = bytes(range(256)) * 1024
+
+    session = requests.Session()
+    handler = type("Handler", (WheelHandler,), {"wheel": data, "ranges": True})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        url = f"http://127.0.0.1:{server.server_port}/file"
+        f = ghpypi.RangeFile(session, url, len(data), data[-10:])
+        ghpypi.statistics.reset()
+
+        # the end of the file is already here
+        f.seek(-10, io.SEEK_END)
+        assert f.read() == data[-10:]
+        assert ghpypi.statistics.counters["metadata_range_requests"] == 0
+
+        # everything else is read ahead
+        f.seek(100)
+        assert f.read(10) == data[100:110]
+        assert f.read(10) == data[110:120]
+        assert ghpypi.statistics.counters["metadata_range_requests"] == 1
+        assert f.tell() == 120
+
+        f.seek(200000)
+        assert f.read(5) == data[200000:200005]
+        assert ghpypi.statistics.counters["metadata_range_requests"] == 2
+    finally:
+        session.close()
+        server.shutdown()
+        server.server_close()
+
+
+@responses.activate
+def test_publish_metadata_range(mocker: MockerFixture):
+    url = "https://github.com/paullockaby/ghpypi/releases/download/v1.0.1/ghpypi-1.0.1-py3-none-any.whl"
+    wheel = Package(
+        filename="ghpypi-1.0.1-py3-none-any.whl",
+        url=url,
+        sha256="ae36bbabd6424037f716c6a78f907d6f9b058ab399a042b2c8530087beca9c3c",
+        uploaded_at=datetime(2021, 12, 25, 6, 16, 9),
+        uploaded_by="github-actions[bot]",
+        name="ghpypi",
+        version=packaging.version.parse("1.0.1"),
+    )
+
+    # wheels that we did not download are read with range requests, which
+    # this server does not support, and anything that goes wrong is skipped
+    responses.get(url, b"not a wheel")
+
+    client = mocker.MagicMock(session=requests.Session())
+    packages = {"ghpypi": {wheel}}
+    ghpypi.publish_metadata(client, packages, ghpypi.Cache(metadata=True))
+    assert packages == {"ghpypi": {wheel}}
+    assert responses.calls[0].request.headers["Range"] == f"bytes=-{ghpypi.RANGE_REQUEST_SIZE}"
+    client.github.get_repo.assert_not_called()
+
+
+def test_parse_filename():
+    ghpypi.parse_filename.cache_clear()
+    assert ghpypi.parse_filename("Aspy.Yaml-0.2.1.tar.gz") == ("aspy-yaml", packaging.version.parse("0.2.1"))
+    assert ghpypi.parse_filename("Aspy.Yaml-0.2.1.tar.gz") == ("aspy-yaml", packaging.version.parse("0.2.1"))
+    assert ghpypi.parse_filename.cache_info().hits == 1
+
+    # failures are not remembered
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            ghpypi.parse_filename("aspy.yaml-0.2.1-py2.whl")
+    assert ghpypi.parse_filename.cache_info().misses == 3
+
+
+@pytest.mark.parametrize("merge_duplicates", (True, False))
+def test_package_spool(merge_duplicates: bool):
+    def make_package(filename: str, repository: str = "ghpypi") -> Package:
+        return ghpypi.create_package(
+            Artifact(
+                filename=filename,
+                url=f"https://github.com/paullockaby/{repository}/releases/download/v1.0.0/{filename}",
+                sha256="fa6dfbe92d7b150b788da980d53f07e6e84c4079118783d5905a72cc9b636ba3",
+                uploaded_at=datetime(2021, 12, 25, 6, 16, 9),
+                uploaded_by="github-actions[bot]",
+                metadata_sha256="ae36bbabd6424037f716c6a78f907d6f9b058ab399a042b2c8530087beca9c3c",
+            ),
+        )
+
+    first = [
+        make_package("ghpypi-1.0.0.tar.gz"),
+        make_package("ghpypi-1.0.0.tar.gz"),
+        make_package("aspy.yaml-0.2.1.tar.gz"),
+    ]
+    second = [make_package("ghpypi-1.0.1.tar.gz", "other")]
+
+    # the spool does the same thing as merging the packages in memory
+    expected: dict[str, set[Package]] = {}
+    ghpypi.merge_packages(expected, ghpypi.create_packages(first), merge_duplicates)
+    ghpypi.merge_packages(expected, ghpypi.create_packages(second), merge_duplicates)
+
+    with ghpypi.PackageSpool(merge_duplicates) as spool:
+        # the order that they are added in does not matter
+        spool.add(1, iter(second))
+        spool.add(0, iter(first))
+
+        assert list(spool) == ["aspy-yaml", "ghpypi"]
+        assert len(spool) == 2
+        assert dict(spool.items()) == expected
+        with pytest.raises(KeyError):
+            spool["missing"]
+
+        spool["ghpypi"] = {make_package("ghpypi-2.0.0.tar.gz")}
+        assert spool["ghpypi"] == {make_package("ghpypi-2.0.0.tar.gz")}
+
+        del spool["aspy-yaml"]
+        assert list(spool) == ["ghpypi"]
+        with pytest.raises(KeyError):
+            del spool["aspy-yaml"]
+
+
+def test_build_spool(tmp_path: PosixPath):
+    artifacts = [
+        Artifact(
+            filename=filename,
+            url=f"https://github.com/paullockaby/ghpypi/releases/download/v1.0.0/{filename}",
+            sha256="fa6dfbe92d7b150b788da980d53f07e6e84c4079118783d5905a72cc9b636ba3",
+            uploaded_at=datetime(2021, 12, 25, 6, 16, 9),
+            uploaded_by="github-actions[bot]",
+        )
+        for filename in ("ghpypi-1.0.1.tar.gz", "ghpypi-1.0.0.tar.gz", "aspy.yaml-0.2.1.tar.gz")
+    ]
+
+    def read_tree(path: PosixPath) -> dict[str, bytes]:
+        return {str(x.relative_to(path)): x.read_bytes() for x in sorted(path.rglob("*")) if x.is_file()}
+
+    ghpypi.build(ghpypi.create_packages(artifacts), str(tmp_path / "memory"), "My Private PyPI", shard_index=True)
+    with ghpypi.PackageSpool() as spool:
+        spool.add(0, ghpypi.iter_packages(artifacts))
+        ghpypi.build(spool, str(tmp_path / "spool"), "My Private PyPI", jobs=2, shard_index=True)
+
+    assert read_tree(tmp_path / "memory") == read_tree(tmp_path / "spool")
+
+
+def test_compact_records():
+    values = {
+        "filename": "ghpypi-1.0.1-py3-none-any.whl",
+        "url": "https://github.com/paullockaby/ghpypi/releases/download/v1.0.1/ghpypi-1.0.1-py3-none-any.whl",
+        "sha256": "ae36bbabd6424037f716c6a78f907d6f9b058ab399a042b2c8530087beca9c3c",
+        "uploaded_at": datetime(2021, 12, 25, 6, 16, 9),
+        "uploaded_by": "github-actions[bot]",
+        "metadata_sha256": "fa6dfbe92d7b150b788da980d53f07e6e84c4079118783d5905a72cc9b636ba3",
+    }
+    artifact = Artifact(**values)
+
+    # everything comes back out the way that it went in
+    assert artifact._asdict() == values
+    assert {name: getattr(artifact, name) for name in Artifact._fields} == values
+    assert repr(artifact).startswith("Artifact(filename='ghpypi-1.0.1-py3-none-any.whl', url=")
+
+    # but it is stored in a smaller way
+    assert artifact._sha256 == bytes.fromhex(values["sha256"])
+    assert artifact._uploaded_at == 1640412969
+    assert artifact._url_prefix == "https://github.com/paullockaby/ghpypi/releases/download/v1.0.1/"
+
+    # things that can not be made smaller are kept as they are
+    odd = artifact._replace(
+        url="https://example.com/download?id=1",
+        sha256="NOT A DIGEST",
+        uploaded_at=datetime(2021, 12, 25, 6, 16, 9, 5),
+        metadata_sha256=None,
+    )
+    assert odd.url == "https://example.com/download?id=1"
+    assert odd.sha256 == "NOT A DIGEST"
+    assert odd.uploaded_at == datetime(2021, 12, 25, 6, 16, 9, 5)
+    assert odd.metadata_sha256 is None
+
+    # records work like tuples in sets and can not be changed
+    assert artifact == Artifact(**values)
+    assert artifact != odd
+    assert len({artifact, Artifact(**values), odd}) == 2
+    with pytest.raises(AttributeError):
+        artifact.filename = "other"
+
+    package = ghpypi.create_package(artifact)
+    assert package == Package(name="ghpypi", version=packaging.version.parse("1.0.1"), **values)
+    assert package != artifact
+    assert package._asdict() == {**values, "name": "ghpypi", "version": packaging.version.parse("1.0.1")}
+    assert not hasattr(package, "__dict__")
+
+
+@pytest.mark.parametrize("copier", (copy.copy, copy.deepcopy, lambda x: pickle.loads(pickle.dumps(x))))  # noqa: S301
+def test_compact_records_copy(copier: Callable[[object], object]):
+    artifact = Artifact(
+        filename="ghpypi-1.0.1-py3-none-any.whl",
+        url="https://github.com/paullockaby/ghpypi/releases/download/v1.0.1/ghpypi-1.0.1-py3-none-any.whl",
+        sha256="fa6dfbe92d7b150b788da980d53f07e6e84c4079118783d5905a72cc9b636ba3",
+        uploaded_at=datetime(2021, 12, 25, 6, 16, 9),
+        uploaded_by="github-actions[bot]",
+        metadata_sha256="b" * 64,
+    )
+    odd = artifact._replace(url="https://example.com/download?id=1", sha256="NOT A DIGEST", metadata_sha256=None)
+    package = ghpypi.create_package(artifact)
+
+    # records can go between processes just like the named tuples that they replaced
+    for record in (artifact, odd, package):
+        copied = copier(record)
+        assert type(copied) is type(record)
+        assert copied == record
+        assert copied._asdict() == record._asdict()